@@ -1,6 +1,121 @@
 from django.apps import AppConfig
 
+MODULE_NAME = "cache_manager"
+
+DEFAULT_CFG = {
+    "scan_count": 10000,
+    "clear_batch_size": 5000,
+    "model_cache_versioning": False,
+    "generation_cache_ttl": 5,
+    "sweep_old_generations": True,
+    "sweep_batch_size": 500,
+    "sweep_pause": 0.05,
+    "preload_server_side_cursor": False,
+    "key_index_enabled": False,
+    "item_count_strategy": "exact",
+    "item_count_ttl": 300,
+    "preheat_in_background": True,
+    "preheat_job_ttl": 86400,
+    "preheat_pool_size": 4,
+    "preheat_priority": ["item", "service", "diagnosis", "health_facility"],
+    "compact_encoding": False,
+    "compact_compress_threshold": 256,
+    "row_sync_models": {},
+    "stats_enabled": False,
+    "stats_flush_interval": 10,
+    "preload_ttls": {},
+    "preload_default_ttl": None,
+    "preload_ttl_jitter": 0.1,
+    "early_refresh_window": 0,
+    "early_refresh_sample_rate": 0.01,
+    "startup_warmup_enabled": False,
+    "startup_warmup_models": [],
+    "startup_warmup_budget": 300,
+    "startup_warmup_lock_ttl": 600,
+    "lua_scripts_enabled": True,
+    "local_cache_enabled": False,
+    "local_cache_models": ["item", "service", "diagnosis", "health_facility", "product"],
+    "local_cache_max_entries": 10000,
+    "local_cache_max_bytes": 64 * 1024 * 1024,
+    "local_cache_ttl": 300,
+    "throttle_enabled": False,
+    "throttle_ops_per_sec": 0,
+    "throttle_bytes_per_sec": 0,
+    "throttle_max_latency_ms": 10,
+    "throttle_max_server_ops": 0,
+    "throttle_check_interval": 1,
+    "throttle_backoff_pause": 0.05,
+    "coverage_cache_key_template": "eligibility_{family_id}",
+    "location_user_key_template": "user_districts_{user_id}",
+}
+
 
 class CacheManagerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'cache_manager'
+    name = MODULE_NAME
+
+    scan_count = DEFAULT_CFG["scan_count"]
+    clear_batch_size = DEFAULT_CFG["clear_batch_size"]
+    model_cache_versioning = DEFAULT_CFG["model_cache_versioning"]
+    generation_cache_ttl = DEFAULT_CFG["generation_cache_ttl"]
+    sweep_old_generations = DEFAULT_CFG["sweep_old_generations"]
+    sweep_batch_size = DEFAULT_CFG["sweep_batch_size"]
+    sweep_pause = DEFAULT_CFG["sweep_pause"]
+    preload_server_side_cursor = DEFAULT_CFG["preload_server_side_cursor"]
+    key_index_enabled = DEFAULT_CFG["key_index_enabled"]
+    item_count_strategy = DEFAULT_CFG["item_count_strategy"]
+    item_count_ttl = DEFAULT_CFG["item_count_ttl"]
+    preheat_in_background = DEFAULT_CFG["preheat_in_background"]
+    preheat_job_ttl = DEFAULT_CFG["preheat_job_ttl"]
+    preheat_pool_size = DEFAULT_CFG["preheat_pool_size"]
+    preheat_priority = DEFAULT_CFG["preheat_priority"]
+    compact_encoding = DEFAULT_CFG["compact_encoding"]
+    compact_compress_threshold = DEFAULT_CFG["compact_compress_threshold"]
+    row_sync_models = DEFAULT_CFG["row_sync_models"]
+    stats_enabled = DEFAULT_CFG["stats_enabled"]
+    stats_flush_interval = DEFAULT_CFG["stats_flush_interval"]
+    preload_ttls = DEFAULT_CFG["preload_ttls"]
+    preload_default_ttl = DEFAULT_CFG["preload_default_ttl"]
+    preload_ttl_jitter = DEFAULT_CFG["preload_ttl_jitter"]
+    early_refresh_window = DEFAULT_CFG["early_refresh_window"]
+    early_refresh_sample_rate = DEFAULT_CFG["early_refresh_sample_rate"]
+    startup_warmup_enabled = DEFAULT_CFG["startup_warmup_enabled"]
+    startup_warmup_models = DEFAULT_CFG["startup_warmup_models"]
+    startup_warmup_budget = DEFAULT_CFG["startup_warmup_budget"]
+    startup_warmup_lock_ttl = DEFAULT_CFG["startup_warmup_lock_ttl"]
+    lua_scripts_enabled = DEFAULT_CFG["lua_scripts_enabled"]
+    local_cache_enabled = DEFAULT_CFG["local_cache_enabled"]
+    local_cache_models = DEFAULT_CFG["local_cache_models"]
+    local_cache_max_entries = DEFAULT_CFG["local_cache_max_entries"]
+    local_cache_max_bytes = DEFAULT_CFG["local_cache_max_bytes"]
+    local_cache_ttl = DEFAULT_CFG["local_cache_ttl"]
+    throttle_enabled = DEFAULT_CFG["throttle_enabled"]
+    throttle_ops_per_sec = DEFAULT_CFG["throttle_ops_per_sec"]
+    throttle_bytes_per_sec = DEFAULT_CFG["throttle_bytes_per_sec"]
+    throttle_max_latency_ms = DEFAULT_CFG["throttle_max_latency_ms"]
+    throttle_max_server_ops = DEFAULT_CFG["throttle_max_server_ops"]
+    throttle_check_interval = DEFAULT_CFG["throttle_check_interval"]
+    throttle_backoff_pause = DEFAULT_CFG["throttle_backoff_pause"]
+    coverage_cache_key_template = DEFAULT_CFG["coverage_cache_key_template"]
+    location_user_key_template = DEFAULT_CFG["location_user_key_template"]
+
+    def ready(self):
+        from core.models import ModuleConfiguration
+        cfg = ModuleConfiguration.get_or_default(MODULE_NAME, DEFAULT_CFG)
+        self.__load_config(cfg)
+
+        from cache_manager.signals import bind_cache_signals
+        bind_cache_signals()
+
+        if CacheManagerConfig.startup_warmup_enabled:
+            from cache_manager.jobs import start_startup_warmup
+            start_startup_warmup()
+
+    @classmethod
+    def __load_config(cls, cfg):
+        """
+        Load all config fields that match current AppConfig class fields, all custom fields have to be loaded separately
+        """
+        for field in cfg:
+            if hasattr(CacheManagerConfig, field):
+                setattr(CacheManagerConfig, field, cfg[field])
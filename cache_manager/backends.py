@@ -0,0 +1,186 @@
+import logging
+import time
+
+from django.core.cache import caches
+from django_redis.cache import RedisCache
+
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.local_cache import MISSING as _MISSING, broadcast_keyed_invalidation, get_local_cache, \
+    is_local_model
+from cache_manager.serializers import UndecodableEntryError
+from cache_manager.stats import CacheStatsCollector, HITS, MISSES, SETS, DELETES
+
+logger = logging.getLogger(__name__)
+
+_stats_collector = CacheStatsCollector()
+
+
+class CacheManagerRedisCache(RedisCache):
+    """
+    django-redis cache backend maintaining the key index of the cache manager on writes and deletes,
+    so that cacheInfo counts the cached entries without scanning Redis, and recording the hits, misses,
+    sets, deletes and get latencies of each model when stats_enabled is set (kept in the default cache Redis).
+    With early_refresh_window, the preloaded entries read close to their expiry are refreshed in the background.
+    With local_cache_enabled, the entries of the local_cache_models are also kept in an in-process LRU
+    (cache_manager.local_cache), invalidated in every process on writes.
+    The compact entries that cannot be decoded are read as misses.
+    Set it as BACKEND of the default, location and coverage caches.
+    """
+    maintains_key_index = True
+
+    def get(self, key, default=None, *args, **kwargs):
+        local_model = self._get_local_model(key)
+        if not local_model and not CacheManagerConfig.stats_enabled and not CacheManagerConfig.early_refresh_window:
+            return self._get_remote(key, default, *args, **kwargs)
+        started = time.perf_counter()
+        value = _MISSING
+        if local_model:
+            full_key = str(self.make_key(key, kwargs.get("version")))
+            value = get_local_cache().get(full_key)
+        if value is _MISSING:
+            # an invalidation received while reading Redis may be newer than the value read
+            invalidations = get_local_cache().invalidations
+            value = self._get_remote(key, _MISSING, *args, **kwargs)
+            if value is not _MISSING and local_model:
+                get_local_cache().set(full_key, local_model, value, invalidations)
+        self._record_stats([key], HITS if value is not _MISSING else MISSES, time.perf_counter() - started)
+        if value is not _MISSING and CacheManagerConfig.early_refresh_window:
+            self._refresh_if_expiring(key)
+        return default if value is _MISSING else value
+
+    def get_many(self, keys, *args, **kwargs):
+        keys = list(keys)
+        local_models = {key: self._get_local_model(key) for key in keys} if CacheManagerConfig.local_cache_enabled \
+            else {}
+        local_keys = {key: str(self.make_key(key, kwargs.get("version"))) for key, model in local_models.items() if model}
+        if not local_keys and not CacheManagerConfig.stats_enabled:
+            return self._get_many_remote(keys, *args, **kwargs)
+        started = time.perf_counter()
+        values = {}
+        for key, full_key in local_keys.items():
+            value = get_local_cache().get(full_key)
+            if value is not _MISSING:
+                values[key] = value
+        remote_keys = [key for key in keys if key not in values]
+        if remote_keys:
+            invalidations = get_local_cache().invalidations
+            remote_values = self._get_many_remote(remote_keys, *args, **kwargs)
+            for key, value in remote_values.items():
+                if key in local_keys:
+                    get_local_cache().set(local_keys[key], local_models[key], value, invalidations)
+            values.update(remote_values)
+        latency = time.perf_counter() - started
+        hits = [key for key in keys if key in values]
+        misses = [key for key in keys if key not in values]
+        # the latency of the call is recorded once
+        self._record_stats(hits, HITS, latency)
+        self._record_stats(misses, MISSES, None if hits else latency)
+        return values
+
+    def _get_remote(self, key, default, *args, **kwargs):
+        try:
+            return super().get(key, default, *args, **kwargs)
+        except UndecodableEntryError:
+            return default
+
+    def _get_many_remote(self, keys, *args, **kwargs):
+        try:
+            return super().get_many(keys, *args, **kwargs)
+        except UndecodableEntryError:
+            # read again one by one, so that only the undecodable entries are misses
+            values = {key: self._get_remote(key, _MISSING, version=kwargs.get("version")) for key in keys}
+            return {key: value for key, value in values.items() if value is not _MISSING}
+
+    def set(self, key, value, *args, **kwargs):
+        result = super().set(key, value, *args, **kwargs)
+        if result:
+            self._after_write([key], kwargs.get("version"))
+            self._record_stats([key], SETS)
+        return result
+
+    def add(self, key, value, *args, **kwargs):
+        result = super().add(key, value, *args, **kwargs)
+        if result:
+            self._after_write([key], kwargs.get("version"))
+            self._record_stats([key], SETS)
+        return result
+
+    def set_many(self, data, *args, **kwargs):
+        result = super().set_many(data, *args, **kwargs)
+        self._after_write(list(data), kwargs.get("version"))
+        self._record_stats(list(data), SETS)
+        return result
+
+    def delete(self, key, *args, **kwargs):
+        result = super().delete(key, *args, **kwargs)
+        self._after_write([key], kwargs.get("version"), remove=True)
+        self._record_stats([key], DELETES)
+        return result
+
+    def delete_many(self, keys, *args, **kwargs):
+        keys = list(keys)
+        result = super().delete_many(keys, *args, **kwargs)
+        self._after_write(keys, kwargs.get("version"), remove=True)
+        self._record_stats(keys, DELETES)
+        return result
+
+    def _get_local_model(self, key):
+        """
+        Returns the model of the key when its entries are kept in the local cache and the local cache is usable.
+        """
+        if not CacheManagerConfig.local_cache_enabled:
+            return None
+        from cache_manager.services import get_cache_key_model
+        model = get_cache_key_model(key, self.key_prefix)
+        if is_local_model(model) and get_local_cache().ensure_subscribed(self.client.get_client()):
+            return model
+        return None
+
+    def _after_write(self, keys, version=None, remove=False):
+        """
+        Updates the key index and invalidates the local caches for written or deleted keys.
+        """
+        if not keys or not (CacheManagerConfig.key_index_enabled or CacheManagerConfig.local_cache_enabled):
+            return
+        from cache_manager.services import get_cache_key_model, add_index_members, remove_index_members
+        try:
+            keyed_models = []
+            for key in keys:
+                model = get_cache_key_model(key, self.key_prefix)
+                if model:
+                    keyed_models.append((str(self.make_key(key, version)), model))
+            if not keyed_models:
+                return
+            if CacheManagerConfig.local_cache_enabled:
+                broadcast_keyed_invalidation(self.client.get_client(), keyed_models)
+            if not CacheManagerConfig.key_index_enabled:
+                return
+            if remove:
+                remove_index_members(self.client.get_client(), keyed_models)
+            else:
+                add_index_members(self.client.get_client(), keyed_models)
+        except Exception as exc:
+            logger.warning("Failed to update the cache key index: %s", exc)
+
+    def _refresh_if_expiring(self, key):
+        from cache_manager.services import refresh_if_expiring
+        try:
+            refresh_if_expiring(self, key)
+        except Exception as exc:
+            logger.warning("Failed to check the expiry of %s: %s", key, exc)
+
+    def _record_stats(self, keys, event, latency=None):
+        if not CacheManagerConfig.stats_enabled or not keys:
+            return
+        from cache_manager.services import get_cache_key_model
+        try:
+            counts = {}
+            for key in keys:
+                model = get_cache_key_model(key, self.key_prefix)
+                if model:
+                    counts[model] = counts.get(model, 0) + 1
+            for model, count in counts.items():
+                _stats_collector.record(model, event, count, latency)
+            _stats_collector.flush_if_due(caches['default'].client.get_client())
+        except Exception as exc:
+            logger.warning("Failed to record the cache statistics: %s", exc)
@@ -0,0 +1,121 @@
+"""
+Preheating of the coverage cache in the shape read by the coverage enquiry of the policy module: one entry per
+family (per insuree without family), keyed by coverage_cache_key_template, mapping the id of each of its insurees
+to the summary of its latest valid policy (product limits and what is left of them after the insuree claims made
+during the policy period). policy.services.EligibilityService.request reads these entries as
+cache["eligibility_{family_id or insuree_id}"][str(insuree_id)], after resolving the insuree from its CHF id.
+The insurees are streamed by chunks of families, and the summaries of a chunk are computed by one grouped query
+joining InsureePolicy, Policy, Product, Insuree and Claim.
+"""
+from django.db.models import Count, F, Q
+from django.db.models.functions import Coalesce
+
+from cache_manager.apps import CacheManagerConfig
+from claim.models import Claim
+from insuree.models import Family, Insuree, InsureePolicy
+from medical.models import Service
+
+# the limits of the product and their consumption, as the enquiry reads them
+COVERAGE_PRODUCT_FIELDS = (
+    "policy__product_id",
+    "policy__product__max_no_surgery",
+    "policy__product__max_amount_surgery",
+    "policy__product__max_amount_consultation",
+    "policy__product__max_amount_delivery",
+    "policy__product__max_amount_antenatal",
+    "policy__product__max_amount_hospitalization",
+)
+COVERAGE_BATCH_SIZE = 1000
+COVERAGE_TOTALS = (
+    ("total_admissions", Service.CATEGORY_HOSPITALIZATION, "policy__product__max_no_hospitalization"),
+    ("total_consultations", Service.CATEGORY_CONSULTATION, "policy__product__max_no_consultation"),
+    ("total_surgeries", Service.CATEGORY_SURGERY, "policy__product__max_no_surgery"),
+    ("total_deliveries", Service.CATEGORY_DELIVERY, "policy__product__max_no_delivery"),
+    ("total_antenatal", Service.CATEGORY_ANTENATAL, "policy__product__max_no_antenatal"),
+    ("total_visits", Service.CATEGORY_VISIT, "policy__product__max_no_visits"),
+)
+
+
+def get_coverage_cache_key(family_id, insuree_id):
+    return CacheManagerConfig.coverage_cache_key_template.format(family_id=family_id or insuree_id,
+                                                                 insuree_id=insuree_id)
+
+
+def get_claims_filter(category):
+    """
+    Filters the valid claims of the category made during the period of the policy, with a service not rejected.
+    """
+    return Q(
+        insuree__claim__status__gt=Claim.STATUS_ENTERED,
+        insuree__claim__category=category,
+        insuree__claim__date_from__gte=F("effective_date"),
+        insuree__claim__date_from__lte=F("expiry_date"),
+        insuree__validity_to__isnull=True,
+        insuree__claim__validity_to__isnull=True,
+        insuree__claim__services__validity_to__isnull=True,
+    ) & (Q(insuree__claim__services__rejection_reason=0) | Q(insuree__claim__services__rejection_reason__isnull=True))
+
+
+def get_coverage_summaries(insuree_filter):
+    """
+    Returns {insuree id: summary of its latest valid policy} for the insurees matching the filter (on the
+    InsureePolicy rows), with one query.
+    """
+    queryset = InsureePolicy.objects.filter(
+        insuree_filter,
+        validity_to__isnull=True,
+        policy__validity_to__isnull=True,
+        policy__product__validity_to__isnull=True,
+    ).values("insuree_id", *COVERAGE_PRODUCT_FIELDS)
+    for total, category, limit in COVERAGE_TOTALS:
+        queryset = queryset.annotate(**{
+            total: Coalesce(Count("insuree__claim", filter=get_claims_filter(category), distinct=True), 0)
+        }).annotate(**{f"{total}_left": F(limit) - F(total)})
+
+    summaries = {}
+    for row in queryset.order_by("insuree_id", "-expiry_date"):
+        insuree_id = row.pop("insuree_id")
+        summaries.setdefault(insuree_id, row)
+    return summaries
+
+
+def build_coverage_cache_data(insurees, insuree_filter):
+    """
+    Builds the {cache key: {insuree id: summary}} entries of the given (id, family id) insurees, matched by
+    insuree_filter, the insurees without policy having a None summary.
+    """
+    summaries = get_coverage_summaries(insuree_filter)
+    cache_data = {}
+    for insuree_id, family_id in insurees:
+        cache_data.setdefault(get_coverage_cache_key(family_id, insuree_id), {})[str(insuree_id)] = \
+            summaries.get(insuree_id)
+    return cache_data
+
+
+def count_coverage_entries():
+    """
+    Returns the number of entries written by a preheating: one per valid family with valid insurees and one per
+    valid insuree without family.
+    """
+    valid_insurees = Insuree.objects.filter(validity_to__isnull=True)
+    families = valid_insurees.filter(family__isnull=False, family__validity_to__isnull=True) \
+        .values("family_id").distinct().count()
+    return families + valid_insurees.filter(family__isnull=True).count()
+
+
+def iter_coverage_chunks(batch_size=None):
+    """
+    Yields the (id, family id) of the valid insurees of ranges of batch_size (COVERAGE_BATCH_SIZE by default)
+    families, so that the insurees of a family are in the same chunk, then of ranges of insurees without family,
+    each with the filter of the InsureePolicy rows of the range.
+    """
+    from cache_manager.services import chunked_queryset
+    batch_size = batch_size or COVERAGE_BATCH_SIZE
+    valid_insurees = Insuree.objects.filter(validity_to__isnull=True)
+    for families in chunked_queryset(Family.objects.filter(validity_to__isnull=True), batch_size, "id"):
+        first, last = families[0][0], families[-1][0]
+        insurees = list(valid_insurees.filter(family_id__gte=first, family_id__lte=last).values_list("id", "family_id"))
+        yield insurees, Q(insuree__family_id__gte=first, insuree__family_id__lte=last)
+    for insurees in chunked_queryset(valid_insurees.filter(family__isnull=True), batch_size, "id", "family_id"):
+        first, last = insurees[0][0], insurees[-1][0]
+        yield insurees, Q(insuree__family__isnull=True, insuree_id__gte=first, insuree_id__lte=last)
@@ -0,0 +1,303 @@
+import atexit
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import caches
+from django.db import connection
+from django.utils import timezone
+
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.scripts import release_lock
+from cache_manager.services import CacheService
+
+logger = logging.getLogger(__name__)
+
+STARTUP_WARMUP_LOCK_KEY = "cache_manager:startup_warmup:lock"
+# set to 1 or 0 to force or prevent the startup warm-up of a process
+STARTUP_WARMUP_ENV = "CACHE_MANAGER_STARTUP_WARMUP"
+MANAGEMENT_SCRIPTS = {"manage.py", "django-admin", "django-admin.py", "__main__.py"}
+
+
+class PreheatJobService:
+    """
+    Runs cache preheating in background threads. The state of each job (progress, throughput, ETA) is
+    kept in the default cache, so that any worker can report it or request its cancellation.
+    The models of a job are preheated concurrently by a bounded pool of workers, each with its own
+    database connection, the models of preheat_priority first.
+    """
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    FINISHED_STATUSES = {STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED}
+
+    @staticmethod
+    def get_models(models):
+        """
+        Validates the requested models, "all" standing for all the supported ones, and sorts them by priority.
+        """
+        models = [model.lower() for model in models]
+        if "all" in models:
+            models = list(CacheService.openimis_models)
+        unsupported = [model for model in models if model not in CacheService.openimis_models]
+        if unsupported:
+            raise ValueError(f"Unsupported model for cache preheating: {', '.join(unsupported)}")
+        priority = CacheManagerConfig.preheat_priority
+        return sorted(dict.fromkeys(models),
+                      key=lambda model: (priority.index(model) if model in priority else len(priority), model))
+
+    @staticmethod
+    def create(models, job_id=None, incremental=False, batch_size=None):
+        """
+        Creates and saves the record of a job preheating the given models, only their changes since the
+        previous preheating with incremental, loading batch_size rows at once (the default of the service if None).
+        """
+        job = {
+            "job_id": str(job_id or uuid.uuid4()),
+            "status": PreheatJobService.STATUS_QUEUED,
+            "incremental": incremental,
+            "batch_size": batch_size,
+            "models": [new_model_progress(model) for model in PreheatJobService.get_models(models)],
+            "rows_loaded": 0,
+            "keys_written": 0,
+            "total_rows": None,
+            "throughput": None,
+            "eta_seconds": None,
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+        }
+        PreheatJobService.save(job)
+        return job
+
+    @staticmethod
+    def start_created(job, user, pool_size=None):
+        """
+        Starts preheating the model caches of a created job in a background thread.
+        """
+        thread = threading.Thread(target=PreheatJobService.run, args=(job, user, pool_size),
+                                  name=f"cache_manager-preheat-{job['job_id']}", daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def get(job_id):
+        return caches['default'].get(get_job_key(job_id))
+
+    @staticmethod
+    def save(job):
+        job["updated_at"] = timezone.now()
+        caches['default'].set(get_job_key(job["job_id"]), job, timeout=CacheManagerConfig.preheat_job_ttl)
+
+    @staticmethod
+    def cancel(job_id):
+        """
+        Requests the cancellation of a job, its running models stop after their current batch.
+        Returns False if the job does not exist or is already finished.
+        """
+        job = PreheatJobService.get(job_id)
+        if not job or job["status"] in PreheatJobService.FINISHED_STATUSES:
+            return False
+        caches['default'].set(get_cancel_key(job_id), True, timeout=CacheManagerConfig.preheat_job_ttl)
+        return True
+
+    @staticmethod
+    def is_cancelled(job_id):
+        return bool(caches['default'].get(get_cancel_key(job_id)))
+
+    @staticmethod
+    def run(job, user, pool_size=None):
+        """
+        Preheats the models of the job with a pool of pool_size (by default preheat_pool_size) workers
+        and returns the finished job.
+        """
+        started = time.monotonic()
+        lock = threading.Lock()
+        job["status"] = PreheatJobService.STATUS_RUNNING
+        job["started_at"] = timezone.now()
+        PreheatJobService.save(job)
+
+        def preheat(model_progress):
+            try:
+                return PreheatJobService.run_model(job, model_progress, user, lock, started)
+            finally:
+                connection.close()
+
+        pool_size = max(1, min(pool_size or CacheManagerConfig.preheat_pool_size, len(job["models"])))
+        with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="cache_manager-preheat") as executor:
+            list(executor.map(preheat, job["models"]))
+
+        statuses = {model_progress["status"] for model_progress in job["models"]}
+        if PreheatJobService.STATUS_FAILED in statuses:
+            job["status"] = PreheatJobService.STATUS_FAILED
+            job["error"] = "; ".join(f"{model_progress['model']}: {model_progress['error']}"
+                                     for model_progress in job["models"] if model_progress["error"])
+        elif PreheatJobService.STATUS_CANCELLED in statuses:
+            job["status"] = PreheatJobService.STATUS_CANCELLED
+        else:
+            job["status"] = PreheatJobService.STATUS_DONE
+        job["finished_at"] = timezone.now()
+        job["eta_seconds"] = None
+        PreheatJobService.save(job)
+        logger.info("Preheat job %s %s: %s rows loaded, %s keys written in %.1fs", job["job_id"], job["status"],
+                    job["rows_loaded"], job["keys_written"], time.monotonic() - started)
+        return job
+
+    @staticmethod
+    def run_model(job, model_progress, user, lock, job_started):
+        model = model_progress["model"]
+        model_started = time.monotonic()
+        if PreheatJobService.is_cancelled(job["job_id"]):
+            model_progress["status"] = PreheatJobService.STATUS_CANCELLED
+            return model_progress
+        try:
+            model_progress["status"] = PreheatJobService.STATUS_RUNNING
+            model_progress["total_rows"] = CacheService.items_count_info(model)["count"]
+            with lock:
+                update_job_progress(job, time.monotonic() - job_started)
+                PreheatJobService.save(job)
+
+            def progress(rows_loaded, keys_written):
+                with lock:
+                    model_progress["rows_loaded"] = rows_loaded
+                    model_progress["keys_written"] = keys_written
+                    model_progress["elapsed"] = time.monotonic() - model_started
+                    update_job_progress(job, time.monotonic() - job_started)
+                    PreheatJobService.save(job)
+                return not PreheatJobService.is_cancelled(job["job_id"])
+
+            completed = CacheService.preload_model_cache(model, user, progress=progress,
+                                                         incremental=job.get("incremental", False),
+                                                         batch_size=job.get("batch_size"))
+            model_progress["status"] = PreheatJobService.STATUS_DONE if completed \
+                else PreheatJobService.STATUS_CANCELLED
+        except Exception as exc:
+            logger.error("Preheating %s in job %s failed: %s", model, job["job_id"], exc)
+            model_progress["status"] = PreheatJobService.STATUS_FAILED
+            model_progress["error"] = str(exc)
+        with lock:
+            model_progress["elapsed"] = time.monotonic() - model_started
+            update_job_progress(job, time.monotonic() - job_started)
+            PreheatJobService.save(job)
+        return model_progress
+
+
+def is_serving_process(argv=None, environ=None):
+    """
+    Tells if the process serves requests and should warm the caches up: an application server, or the reloaded
+    child of runserver, but not the other management commands (migrate, test, preheat_cache...) whose short life
+    would leave the warm-up lock taken. STARTUP_WARMUP_ENV overrides the guess.
+    """
+    argv = sys.argv if argv is None else argv
+    environ = os.environ if environ is None else environ
+    if environ.get(STARTUP_WARMUP_ENV):
+        return environ[STARTUP_WARMUP_ENV].lower() in ("1", "true", "yes")
+    if not argv or os.path.basename(argv[0]) not in MANAGEMENT_SCRIPTS:
+        return True
+    if len(argv) < 2 or argv[1] != "runserver":
+        return False
+    # the autoreloader runs the server in a child process
+    return "--noreload" in argv or environ.get("RUN_MAIN") == "true"
+
+
+def start_startup_warmup():
+    """
+    Starts the warm-up of the caches in a background thread, so that the startup is not delayed.
+    Does nothing in the processes not serving requests, see is_serving_process.
+    """
+    if not is_serving_process():
+        return None
+    thread = threading.Thread(target=run_startup_warmup, name="cache_manager-startup-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def run_startup_warmup():
+    """
+    Preheats the startup_warmup_models (preheat_priority if empty), in priority order, for at most
+    startup_warmup_budget seconds. Only the node taking the warm-up lock does it, so that the replicas of a rollout
+    warm the caches once. The lock is released when the warm-up ends or the process exits, and expires after
+    startup_warmup_lock_ttl seconds if the process is killed.
+    """
+    lock_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+    locked = False
+    try:
+        if not caches['default'].add(STARTUP_WARMUP_LOCK_KEY, lock_owner,
+                                     timeout=CacheManagerConfig.startup_warmup_lock_ttl):
+            logger.info("Cache warm-up skipped, it is run by %s", caches['default'].get(STARTUP_WARMUP_LOCK_KEY))
+            return None
+        locked = True
+        atexit.register(release_startup_warmup_lock, lock_owner)
+        job = PreheatJobService.create(CacheManagerConfig.startup_warmup_models
+                                       or CacheManagerConfig.preheat_priority)
+        thread = PreheatJobService.start_created(job, None)
+        thread.join(CacheManagerConfig.startup_warmup_budget)
+        if thread.is_alive():
+            logger.warning("Cache warm-up budget of %ss exceeded, cancelling job %s",
+                           CacheManagerConfig.startup_warmup_budget, job["job_id"])
+            PreheatJobService.cancel(job["job_id"])
+            thread.join()
+        for model_progress in job["models"]:
+            logger.info("Cache warm-up of %s %s: %s rows loaded, %s keys written", model_progress["model"],
+                        model_progress["status"], model_progress["rows_loaded"], model_progress["keys_written"])
+        return job
+    except Exception as exc:
+        logger.error("Cache warm-up failed: %s", exc)
+        return None
+    finally:
+        if locked:
+            atexit.unregister(release_startup_warmup_lock)
+            release_startup_warmup_lock(lock_owner)
+        connection.close()
+
+
+def release_startup_warmup_lock(lock_owner):
+    """
+    Releases the warm-up lock if it is still held by lock_owner, so that it is not released after it expired
+    and was taken by another process.
+    """
+    cache = caches['default']
+    try:
+        release_lock(cache.client.get_client(), cache.make_key(STARTUP_WARMUP_LOCK_KEY),
+                     cache.client.encode(lock_owner))
+    except Exception as exc:
+        logger.warning("Failed to release the cache warm-up lock: %s", exc)
+
+
+def get_job_key(job_id):
+    return f"cache_manager:preheat_job:{job_id}"
+
+
+def get_cancel_key(job_id):
+    return f"cache_manager:preheat_job:{job_id}:cancel"
+
+
+def new_model_progress(model):
+    return {
+        "model": model,
+        "status": PreheatJobService.STATUS_QUEUED,
+        "rows_loaded": 0,
+        "keys_written": 0,
+        "total_rows": None,
+        "elapsed": None,
+        "error": None,
+    }
+
+
+def update_job_progress(job, elapsed):
+    """
+    Sums up the counters of the models of the job, with its throughput (rows per second) and ETA (seconds).
+    """
+    job["rows_loaded"] = sum(model_progress["rows_loaded"] for model_progress in job["models"])
+    job["keys_written"] = sum(model_progress["keys_written"] for model_progress in job["models"])
+    job["total_rows"] = sum(model_progress["total_rows"] or 0 for model_progress in job["models"])
+    job["throughput"] = job["rows_loaded"] / elapsed if elapsed > 0 else None
+    if job["throughput"]:
+        job["eta_seconds"] = max(job["total_rows"] - job["rows_loaded"], 0) / job["throughput"]
@@ -0,0 +1,178 @@
+"""
+In-process LRU cache in front of Redis for the entries of the reference models read on almost every request
+(local_cache_models). Entries are kept pickled, so that each read gets its own copy, bounded by
+local_cache_max_entries and local_cache_max_bytes, and expire after local_cache_ttl seconds at the latest.
+Writes, clears and row synchronization publish the invalidated keys or models on a Redis channel, each process
+evicting them from its local cache; the local cache is emptied and bypassed while the process is not subscribed.
+"""
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from cache_manager.apps import CacheManagerConfig
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "cache_manager:invalidate"
+# above this number of keys of a model, a write invalidates the whole model instead of publishing each key
+KEY_BROADCAST_LIMIT = 1000
+RESUBSCRIBE_DELAY = 1
+
+MISSING = object()
+
+
+class LocalCache:
+    """
+    Thread-safe LRU of pickled entries keyed by their full Redis key, with the model of each entry.
+    Every eviction increments invalidations: a reader takes it before reading Redis and passes it to set, which
+    drops the value if an invalidation happened in between, as the value read may be older than the invalidation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.invalidations = 0
+        self.pid = None
+        self.subscribed = False
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            data, _, _, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return MISSING
+            self.entries.move_to_end(key)
+        return pickle.loads(data)
+
+    def set(self, key, model, value, invalidations=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > CacheManagerConfig.local_cache_max_bytes:
+            return
+        with self.lock:
+            if invalidations is not None and invalidations != self.invalidations:
+                return
+            self._remove(key)
+            self.entries[key] = (data, len(data), model, time.monotonic() + CacheManagerConfig.local_cache_ttl)
+            self.bytes += len(data)
+            while self.entries and (len(self.entries) > CacheManagerConfig.local_cache_max_entries
+                                    or self.bytes > CacheManagerConfig.local_cache_max_bytes):
+                _, (_, size, _, _) = self.entries.popitem(last=False)
+                self.bytes -= size
+
+    def evict_keys(self, keys):
+        with self.lock:
+            self.invalidations += 1
+            for key in keys:
+                self._remove(key)
+
+    def evict_models(self, models):
+        models = set(models)
+        with self.lock:
+            self.invalidations += 1
+            for key in [key for key, entry in self.entries.items() if entry[2] in models]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += 1
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.bytes -= entry[1]
+
+    def ensure_subscribed(self, redis_client):
+        """
+        Starts listening to the invalidations in this process (again after a fork) and tells if the
+        local cache can be used, i.e. if the process is subscribed.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.subscribed = False
+                    self.invalidations += 1
+                    self.entries.clear()
+                    self.bytes = 0
+                    threading.Thread(target=self.listen, args=(redis_client,),
+                                     name="cache_manager-local-cache", daemon=True).start()
+        return self.subscribed
+
+    def listen(self, redis_client):
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                self.subscribed = True
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        self.apply(json.loads(message["data"]))
+            except Exception as exc:
+                logger.warning("Local cache invalidations interrupted: %s", exc)
+            finally:
+                # invalidations may have been missed
+                self.subscribed = False
+                self.clear()
+            time.sleep(RESUBSCRIBE_DELAY)
+
+    def apply(self, invalidation):
+        if invalidation.get("keys"):
+            self.evict_keys(invalidation["keys"])
+        if invalidation.get("models"):
+            self.evict_models(invalidation["models"])
+
+
+_local_cache = LocalCache()
+
+
+def get_local_cache():
+    return _local_cache
+
+
+def is_local_model(model):
+    return CacheManagerConfig.local_cache_enabled and model in CacheManagerConfig.local_cache_models
+
+
+def broadcast_invalidation(redis_client, keys=None, models=None):
+    """
+    Evicts the keys or all the entries of the models from the local cache of this process and publishes them
+    to the other processes.
+    """
+    if not CacheManagerConfig.local_cache_enabled:
+        return
+    models = [model for model in models or [] if is_local_model(model)]
+    keys = list(keys or [])
+    if not keys and not models:
+        return
+    _local_cache.evict_keys(keys)
+    _local_cache.evict_models(models)
+    redis_client.publish(INVALIDATION_CHANNEL, json.dumps({"keys": keys, "models": models}))
+
+
+def broadcast_keyed_invalidation(redis_client, keyed_models):
+    """
+    Broadcasts the invalidation of written or deleted (full key, model) pairs, by model when a model has more
+    than KEY_BROADCAST_LIMIT keys.
+    """
+    keys, models = [], []
+    keys_by_model = {}
+    for key, model in keyed_models:
+        if is_local_model(model):
+            keys_by_model.setdefault(model, []).append(key)
+    for model, model_keys in keys_by_model.items():
+        if len(model_keys) > KEY_BROADCAST_LIMIT:
+            models.append(model)
+        else:
+            keys += model_keys
+    broadcast_invalidation(redis_client, keys, models)
@@ -0,0 +1,101 @@
+"""
+Preheating of the location module cache for all the users at once: the location hierarchy is loaded once, the
+districts of the users are read by ranges of users with one query per range, and the per user entries are written
+in the format of location.models.UserDistrict.get_user_districts, under location_user_key_template.
+"""
+from django.db.models import Q
+
+from location.apps import LocationConfig
+from location.models import Location, UserDistrict
+from core.models import InteractiveUser, UserRole
+
+from cache_manager.apps import CacheManagerConfig
+
+ADMIN_ROLE_SYSTEM = 64
+# the location graph and the location ids by type
+LOCATION_HIERARCHY_ENTRIES = 2
+
+
+def get_user_districts_key(user_id):
+    return CacheManagerConfig.location_user_key_template.format(user_id=user_id)
+
+
+def build_location_hierarchy():
+    """
+    Returns the location graph ({parent id or "root": {child ids}}) and the location ids by type, as cached by
+    location.models.cache_location_graph.
+    """
+    graph = {}
+    location_types = {}
+    locations = Location.objects.filter(Q(parent__isnull=False) | Q(type="R"), validity_to__isnull=True)
+    for location_id, parent_id, location_type in locations.values_list("id", "parent_id", "type").iterator():
+        graph.setdefault(parent_id or "root", set()).add(location_id)
+        location_types.setdefault(location_type, set()).add(location_id)
+    return graph, location_types
+
+
+def get_admin_user_ids(user_filter):
+    return set(UserRole.objects.filter(
+        user_filter,
+        validity_to__isnull=True,
+        role__validity_to__isnull=True,
+        role__is_system=ADMIN_ROLE_SYSTEM,
+    ).values_list("user_id", flat=True))
+
+
+def build_user_districts_cache_data(user_ids, user_filter, all_districts):
+    """
+    Builds the {cache key: [[user district id, district id], ...]} entries of the given users, matched by
+    user_filter (on the user field), the administrators getting all the districts.
+    """
+    admins = get_admin_user_ids(user_filter)
+    cache_data = {get_user_districts_key(user_id): [] if user_id not in admins else all_districts
+                  for user_id in user_ids}
+    districts = UserDistrict.objects.filter(
+        user_filter,
+        validity_to__isnull=True,
+        location__type="D",
+        location__parent__isnull=False,
+        location__validity_to__isnull=True,
+    ).order_by("user_id", "location__code").values_list("user_id", "id", "location_id")
+    for user_id, user_district_id, location_id in districts.iterator():
+        if user_id not in admins and user_id in user_ids:
+            cache_data[get_user_districts_key(user_id)].append([user_district_id, location_id])
+    return cache_data
+
+
+def iter_user_districts_cache_data(batch_size, location_types):
+    """
+    Yields the number of users and the entries of ranges of batch_size valid interactive users.
+    With the no_location_check of the location module, yields only the entry shared by all the users.
+    """
+    from cache_manager.services import chunked_queryset
+    all_districts = get_all_districts(location_types)
+    if LocationConfig.no_location_check:
+        yield 1, {"user_districts_all": all_districts}
+        return
+    for users in chunked_queryset(InteractiveUser.objects.filter(validity_to__isnull=True), batch_size, "id"):
+        user_ids = {user_id for user_id, in users}
+        user_filter = Q(user_id__gte=users[0][0], user_id__lte=users[-1][0])
+        yield len(users), build_user_districts_cache_data(user_ids, user_filter, all_districts)
+
+
+def count_user_districts_entries():
+    """
+    Returns the number of entries written by a preheating: the location hierarchy and the entry of each valid
+    interactive user, or the one shared by all the users with no_location_check.
+    """
+    if LocationConfig.no_location_check:
+        return LOCATION_HIERARCHY_ENTRIES + 1
+    return LOCATION_HIERARCHY_ENTRIES + InteractiveUser.objects.filter(validity_to__isnull=True).count()
+
+
+def get_all_districts(location_types):
+    return [[0, location_id] for location_id in location_types.get("D", ())]
+
+
+def build_single_user_districts_cache_data(user_id, location_types):
+    """
+    Builds the entry of one user, e.g. after its districts or roles changed.
+    """
+    return build_user_districts_cache_data({user_id}, Q(user_id=user_id), get_all_districts(location_types))
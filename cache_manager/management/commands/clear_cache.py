@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.services import CacheService
+
+
+class Command(BaseCommand):
+    help = "Clears the caches of the given models (all the supported ones with 'all')."
+
+    def add_arguments(self, parser):
+        parser.add_argument("models", nargs="+", help="the models to clear, or all")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="the number of keys removed per pipeline (default: clear_batch_size)")
+
+    def handle(self, *args, **options):
+        models = [model.lower() for model in options["models"]]
+        if "all" in models:
+            models = sorted(CacheService.openimis_models)
+        if options["batch_size"]:
+            CacheManagerConfig.clear_batch_size = options["batch_size"]
+
+        failed = []
+        for model in models:
+            try:
+                result = CacheService.clear_cache(model)
+                self.stdout.write(f"{model}: removed {result['removed_keys']} keys in {result['elapsed']:.3f}s")
+            except Exception as exc:
+                failed.append(model)
+                self.stderr.write(f"{model}: {exc}")
+        if failed:
+            raise CommandError(f"Failed to clear the cache of {', '.join(failed)}")
+        self.stdout.write(self.style.SUCCESS(f"Cleared {len(models)} caches"))
@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cache_manager.jobs import PreheatJobService
+
+
+class Command(BaseCommand):
+    help = "Preheats the caches of the given models (all the supported ones with 'all'), e.g. before a deployment " \
+           "receives traffic. Fails if a model cannot be preheated or the time budget is exceeded."
+
+    def add_arguments(self, parser):
+        parser.add_argument("models", nargs="+", help="the models to preheat, or all")
+        parser.add_argument("--parallel", type=int, default=None,
+                            help="the number of models preheated concurrently (default: preheat_pool_size)")
+        parser.add_argument("--batch-size", type=int, default=None, help="the number of rows loaded at once")
+        parser.add_argument("--time-budget", type=float, default=None,
+                            help="the number of seconds after which preheating is cancelled and the command fails")
+        parser.add_argument("--incremental", action="store_true",
+                            help="only load the rows changed since the previous preheating")
+        parser.add_argument("--progress-interval", type=float, default=5,
+                            help="the number of seconds between two progress lines (default: 5)")
+
+    def handle(self, *args, **options):
+        try:
+            job = PreheatJobService.create(PreheatJobService.get_models(options["models"]),
+                                           incremental=options["incremental"], batch_size=options["batch_size"])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        started = time.monotonic()
+        thread = PreheatJobService.start_created(job, None, pool_size=options["parallel"])
+        self.stdout.write(f"Preheating {', '.join(model['model'] for model in job['models'])} (job {job['job_id']})")
+        statuses = {}
+        cancelled = False
+        while thread.is_alive():
+            thread.join(options["progress_interval"])
+            elapsed = time.monotonic() - started
+            self.write_progress(job, statuses, elapsed)
+            if not cancelled and options["time_budget"] and elapsed > options["time_budget"] and thread.is_alive():
+                self.stderr.write(f"Time budget of {options['time_budget']}s exceeded, cancelling")
+                PreheatJobService.cancel(job["job_id"])
+                cancelled = True
+
+        if job["status"] != PreheatJobService.STATUS_DONE:
+            raise CommandError(f"Preheating {job['status']}" + (f": {job['error']}" if job["error"] else ""))
+        self.stdout.write(self.style.SUCCESS(
+            f"Preheated {job['rows_loaded']} rows into {job['keys_written']} keys in {time.monotonic() - started:.1f}s"))
+
+    def write_progress(self, job, statuses, elapsed):
+        for model_progress in job["models"]:
+            if statuses.get(model_progress["model"]) != model_progress["status"]:
+                statuses[model_progress["model"]] = model_progress["status"]
+                self.stdout.write(f"  {model_progress['model']}: {model_progress['status']}"
+                                  + (f" ({model_progress['error']})" if model_progress["error"] else ""))
+        throughput = f", {job['throughput']:.0f} rows/s" if job["throughput"] else ""
+        eta = f", ETA {job['eta_seconds']:.0f}s" if job["eta_seconds"] is not None else ""
+        self.stdout.write(f"[{elapsed:.0f}s] {job['rows_loaded']}/{job['total_rows'] or '?'} rows{throughput}{eta}")
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cache_manager.reconcile import reconcile_model_cache
+
+
+class Command(BaseCommand):
+    help = "Compares the caches of the given models with the database and reports their missing, stale and " \
+           "orphaned entries. With --repair, only these entries are rewritten or removed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("models", nargs="+", help="the models to reconcile")
+        parser.add_argument("--repair", action="store_true", help="rewrite or remove the drifted entries")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="the number of rows or keys looked up at once (default: 1000)")
+        parser.add_argument("--fail-on-drift", action="store_true",
+                            help="exit with a non-zero status when an entry drifted")
+
+    def handle(self, *args, **options):
+        failed = []
+        drifted = 0
+        for model in [model.lower() for model in options["models"]]:
+            try:
+                report = reconcile_model_cache(model, repair=options["repair"], batch_size=options["batch_size"])
+            except Exception as exc:
+                failed.append(model)
+                self.stderr.write(f"{model}: {exc}")
+                continue
+            drifted += report["missing"] + report["stale"] + report["orphaned"]
+            self.stdout.write(
+                f"{model}: {report['checked_rows']} rows, {report['scanned_keys']} keys, {report['missing']} missing, "
+                f"{report['stale']} stale, {report['orphaned']} orphaned, {report['repaired']} repaired "
+                f"in {report['elapsed']:.3f}s")
+            for kind, ids in report["samples"].items():
+                if ids:
+                    self.stdout.write(f"  {kind}: {', '.join(str(row_id) for row_id in ids)}")
+        if failed:
+            raise CommandError(f"Failed to reconcile the cache of {', '.join(failed)}")
+        if drifted and options["fail_on_drift"] and not options["repair"]:
+            raise CommandError(f"{drifted} cache entries drifted from the database")
+        self.stdout.write(self.style.SUCCESS("Reconciled the caches"))
@@ -0,0 +1,154 @@
+"""
+Reconciliation of the model caches with the database, reporting which entries drifted instead of only comparing
+counts. Both sides are walked by bounded batches, each batch being looked up on the other side:
+- the valid rows are read in primary key order and their entries fetched through one pipeline per batch, an entry
+  being missing when it is not cached and stale when its payload differs from the one the row would preload;
+- the keys of the model are scanned on each Redis server and the ids of a batch of keys queried at once, an entry
+  being orphaned when its row no longer exists or is no longer valid.
+With repair, only the differences are written or removed, so that drift does not require a clear and a reload.
+"""
+import time
+
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.utils.translation import gettext as _
+
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.serializers import UndecodableEntryError
+from cache_manager.services import (CacheService, build_payload_cache_data, chunked_queryset, evict_cache_keys,
+                                    get_model_cache_key, get_node_clients, get_payload_cache_key,
+                                    get_projection_columns, index_cache_keys, set_preloaded_entries,
+                                    use_compact_encoding)
+from cache_manager.throttle import get_throttle
+
+RECONCILE_BATCH_SIZE = 1000
+# number of ids of each kind of drift kept in the report
+DRIFT_SAMPLE_SIZE = 20
+
+
+def reconcile_model_cache(model, repair=False, batch_size=None):
+    """
+    Compares the cache of a model with its valid rows. Only the models of the default cache keyed by row id
+    (the default projection key) can be reconciled.
+    Returns the drift report: the numbers of checked rows and scanned keys, of missing, stale and orphaned
+    entries with a sample of their ids, of repaired entries and the elapsed time.
+    """
+    batch_size = batch_size or RECONCILE_BATCH_SIZE
+    model_class, is_model = CacheService.get_model_class(model)
+    _, _, key = get_projection_columns(model)
+    if not is_model or CacheService.get_model_cache_alias(model) != 'default' \
+            or key is not get_payload_cache_key:
+        raise ValidationError(_("Unsupported_model_for_cache_reconciliation"))
+
+    started = time.monotonic()
+    report = {
+        "model": model,
+        "checked_rows": 0,
+        "scanned_keys": 0,
+        "missing": 0,
+        "stale": 0,
+        "orphaned": 0,
+        "repaired": 0,
+        "samples": {"missing": [], "stale": [], "orphaned": []},
+    }
+    cache = caches['default']
+    throttle = get_throttle(cache.client.get_client())
+    reconcile_rows(cache, model, model_class, report, repair, batch_size, throttle)
+    reconcile_keys(cache, model, model_class, report, repair, batch_size, throttle)
+    report["elapsed"] = time.monotonic() - started
+    return report
+
+
+def reconcile_rows(cache, model, model_class, report, repair, batch_size, throttle):
+    """
+    Finds the missing and stale entries of the valid rows, rewriting them with repair.
+    """
+    _, columns, _ = get_projection_columns(model)
+    redis_client = cache.client.get_client()
+    compact = use_compact_encoding(cache)
+    for chunk in chunked_queryset(model_class.objects.filter(validity_to__isnull=True), batch_size, *columns):
+        payloads = build_payload_cache_data(model, model_class, chunk)
+        keys = list(payloads)
+        pipeline = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(cache.make_key(key))
+        drifted = set()
+        for key, raw in zip(keys, pipeline.execute()):
+            payload = payloads[key]
+            if raw is None:
+                add_drift(report, "missing", payload["id"])
+            elif is_stale_entry(decode_entry(cache, raw), payload):
+                add_drift(report, "stale", payload["id"])
+            else:
+                continue
+            drifted.add(payload["id"])
+        report["checked_rows"] += len(chunk)
+        if throttle:
+            throttle.wait(len(keys))
+        if repair and drifted:
+            rows = [row for row in chunk if row[0] in drifted]
+            cache_data = build_payload_cache_data(model, model_class, rows, compact)
+            set_preloaded_entries(cache, model, cache_data)
+            index_cache_keys(cache, model, cache_data)
+            report["repaired"] += len(cache_data)
+
+
+def reconcile_keys(cache, model, model_class, report, repair, batch_size, throttle):
+    """
+    Finds the orphaned entries by scanning the keys of the model on each Redis server, evicting them with repair.
+    """
+    prefix = CacheService.get_prefixed_model(model)
+    for node_client in get_node_clients(cache.client.get_client()):
+        batch = []
+        for key in node_client.scan_iter(match=f"{prefix}*", count=CacheManagerConfig.scan_count):
+            key = key.decode("utf-8", "replace") if isinstance(key, bytes) else key
+            row_id = key[len(prefix):]
+            # entries of a later generation, or not keyed by row id
+            if not row_id.isdigit():
+                continue
+            batch.append(int(row_id))
+            if len(batch) >= batch_size:
+                reconcile_key_batch(cache, model, model_class, batch, report, repair, throttle)
+                batch = []
+        if batch:
+            reconcile_key_batch(cache, model, model_class, batch, report, repair, throttle)
+
+
+def reconcile_key_batch(cache, model, model_class, ids, report, repair, throttle):
+    valid = set(model_class.objects.filter(pk__in=ids, validity_to__isnull=True).values_list("pk", flat=True))
+    orphaned = [row_id for row_id in ids if row_id not in valid]
+    report["scanned_keys"] += len(ids)
+    for row_id in orphaned:
+        add_drift(report, "orphaned", row_id)
+    if repair and orphaned:
+        evict_cache_keys(cache, model, [get_model_cache_key(model_class, row_id) for row_id in orphaned])
+        report["repaired"] += len(orphaned)
+        if throttle:
+            throttle.wait(len(orphaned))
+
+
+def decode_entry(cache, raw):
+    """
+    Decodes a cached entry, None when it cannot be decoded so that it is reported as stale.
+    """
+    try:
+        return cache.client.decode(raw)
+    except UndecodableEntryError:
+        return None
+
+
+def is_stale_entry(cached, payload):
+    """
+    Tells if a cached entry differs from the payload preloaded for its row. Model instances cached by the other
+    modules are compared on the fields of the payload they have.
+    """
+    if isinstance(cached, models.Model):
+        return any(getattr(cached, name, value) != value for name, value in payload.items())
+    return cached != payload
+
+
+def add_drift(report, kind, row_id):
+    report[kind] += 1
+    if len(report["samples"][kind]) < DRIFT_SAMPLE_SIZE:
+        report["samples"][kind].append(row_id)
@@ -0,0 +1,205 @@
+"""
+Declares the models the cache manager supports and what it preloads for each of them: the columns projected with
+values(), the values read through relations (joined by the same query) and the function building the cache key of
+each payload.
+Models are registered by their "app_label.ModelName" and resolved through the app registry on first use, so that
+importing the cache manager does not import the models of the other modules, and the models of modules that are
+not installed are left out. Other modules can register their own models, e.g. in the ready() of their AppConfig.
+"""
+import threading
+
+from django.apps import apps
+
+DEFAULT_PRELOAD_FIELDS = ("id",)
+
+_preload_projections = {}
+
+_cache_models = {}
+_model_classes = {}
+_supported_models = None
+_cache_models_lock = threading.Lock()
+# incremented by each registration, so that what is derived from the registry elsewhere is derived again
+_registry_version = 0
+
+
+def register_cache_model(model, model_label, module_cache=False, preheat=True, validity=True, count=None):
+    """
+    Registers a model supported by the cache manager.
+    :param model: the name of the model in the cache manager, e.g. "health_facility"
+    :param model_label: the "app_label.ModelName" of the Django model, e.g. "location.HealthFacility"
+    :param module_cache: True when the entries are stored in the cache of a module (see CacheService.cache_modules)
+                         instead of one entry per row in the default cache
+    :param preheat: False for the models that can be counted but not preheated nor cleared
+    :param validity: False for the models without validity_to, all their rows being valid
+    :param count: the dotted path of a function returning the number of cached entries, for the module caches
+                  whose entries are not one per valid row
+    """
+    global _supported_models, _registry_version
+    with _cache_models_lock:
+        _cache_models[model] = {
+            "label": model_label,
+            "module_cache": module_cache,
+            "preheat": preheat,
+            "validity": validity,
+            "count": count,
+        }
+        _model_classes.pop(model, None)
+        _supported_models = None
+        _registry_version += 1
+
+
+def get_registry_version():
+    """
+    Returns the number of registrations so far, to memoize values derived from the registered models or
+    projections until the next registration.
+    """
+    return _registry_version
+
+
+def get_cache_model_options(model):
+    """
+    Returns the options the model was registered with, raises LookupError for an unknown model.
+    """
+    if model not in _cache_models:
+        raise LookupError(f"No cache model registered as {model}")
+    return _cache_models[model]
+
+
+def get_cache_model(model):
+    """
+    Returns the Django model class of the model and whether its entries are stored one per row (False for the
+    module caches). The class is resolved once, raises LookupError when the model is unknown or its module is not
+    installed.
+    """
+    if model not in _model_classes:
+        options = get_cache_model_options(model)
+        _model_classes[model] = (apps.get_model(options["label"]), not options["module_cache"])
+    return _model_classes[model]
+
+
+def get_cache_models():
+    """
+    Returns the names of the models that can be preheated and cleared, those of modules that are not installed
+    being left out.
+    """
+    global _supported_models
+    if _supported_models is None:
+        supported = set()
+        for model, options in list(_cache_models.items()):
+            if not options["preheat"]:
+                continue
+            try:
+                get_cache_model(model)
+            except LookupError:
+                continue
+            supported.add(model)
+        _supported_models = supported
+    return set(_supported_models)
+
+
+class CacheModels:
+    """
+    Class attribute resolved to the names of the supported models on each access, see get_cache_models.
+    """
+
+    def __get__(self, instance, owner):
+        return get_cache_models()
+
+
+def register_preload_projection(model, fields=DEFAULT_PRELOAD_FIELDS, related=None, key=None):
+    """
+    Registers the payload preloaded in cache for each row of a model.
+    :param model: the name of the model, as in CacheService.get_model_class
+    :param fields: the columns of the model table copied in the payload, id is always the first one
+    :param related: {payload name: lookup} of values read through relations, e.g. {"location_code": "location__code"}
+    :param key: function(model_class, payload) returning the cache key of a payload,
+                cache_manager.services.get_model_cache_key of its id by default
+    """
+    global _registry_version
+    _preload_projections[model] = {
+        "fields": ("id", *[field for field in fields if field != "id"]),
+        "related": dict(related or {}),
+        "key": key,
+    }
+    _registry_version += 1
+
+
+def get_preload_projection(model):
+    """
+    Returns the projection registered for the model, or the default one caching only the id.
+    """
+    return _preload_projections.get(model) or {"fields": DEFAULT_PRELOAD_FIELDS, "related": {}, "key": None}
+
+
+def get_preload_projections():
+    """
+    Returns the names of the models with a registered projection.
+    """
+    return list(_preload_projections)
+
+
+register_preload_projection("location", ("id", "uuid", "code", "name", "type", "parent_id"))
+register_preload_projection("health_facility", ("id", "uuid", "code", "name", "location_id"),
+                            related={"location_code": "location__code"})
+register_preload_projection("item", ("id", "uuid", "code", "name", "type", "package", "price", "care_type",
+                                     "frequency", "patient_category"))
+register_preload_projection("service", ("id", "uuid", "code", "name", "type", "level", "price", "care_type",
+                                        "frequency", "patient_category"))
+register_preload_projection("diagnosis", ("id", "uuid", "code", "name"))
+register_preload_projection("product", ("id", "uuid", "code", "name", "location_id", "date_from", "date_to",
+                                        "max_members", "lump_sum"))
+register_preload_projection("claim_admin", ("id", "uuid", "code", "last_name", "other_names", "health_facility_id"))
+register_preload_projection("officer", ("id", "uuid", "code", "last_name", "other_names", "location_id"))
+register_preload_projection("family", ("id", "uuid", "head_insuree_id", "location_id"))
+register_preload_projection("insuree", ("id", "uuid", "chf_id", "last_name", "other_names", "family_id", "dob",
+                                        "gender_id"))
+register_preload_projection("policy", ("id", "uuid", "family_id", "product_id", "status", "enroll_date",
+                                       "start_date", "effective_date", "expiry_date"))
+
+register_cache_model("location_user", "location.Location", module_cache=True,
+                     count="cache_manager.location_user.count_user_districts_entries")
+register_cache_model("coverage", "insuree.InsureePolicy", module_cache=True,
+                     count="cache_manager.coverage.count_coverage_entries")
+register_cache_model("location", "location.Location")
+register_cache_model("health_facility", "location.HealthFacility")
+register_cache_model("user_district", "location.UserDistrict")
+register_cache_model("officer_village", "location.OfficerVillage")
+register_cache_model("claim_admin", "claim.ClaimAdmin")
+register_cache_model("claim", "claim.Claim")
+register_cache_model("claim_item", "claim.ClaimItem")
+register_cache_model("claim_service", "claim.ClaimService")
+register_cache_model("claim_attachment_type", "claim.ClaimAttachmentType")
+register_cache_model("claim_attachment", "claim.ClaimAttachment")
+register_cache_model("claim_ded_rem", "claim.ClaimDedRem")
+register_cache_model("feedback", "claim.Feedback", preheat=False)
+register_cache_model("feedback_prompt", "claim.FeedbackPrompt")
+register_cache_model("premium", "contribution.Premium")
+register_cache_model("role", "core.Role")
+register_cache_model("role_right", "core.RoleRight")
+register_cache_model("interactive_user", "core.InteractiveUser")
+register_cache_model("user_role", "core.UserRole")
+register_cache_model("user", "core.User")
+register_cache_model("officer", "core.Officer")
+register_cache_model("insuree_photo", "insuree.InsureePhoto")
+register_cache_model("family", "insuree.Family")
+register_cache_model("insuree", "insuree.Insuree")
+register_cache_model("insuree_policy", "insuree.InsureePolicy")
+register_cache_model("insuree_status_reason", "insuree.InsureeStatusReason", preheat=False)
+register_cache_model("diagnosis", "medical.Diagnosis")
+register_cache_model("item", "medical.Item")
+register_cache_model("service", "medical.Service")
+register_cache_model("policy", "policy.Policy")
+register_cache_model("policy_renewal", "policy.PolicyRenewal")
+register_cache_model("product", "product.Product")
+register_cache_model("product_service", "product.ProductService")
+register_cache_model("extract", "tools.Extract")
+# counted only, they have no validity_to
+register_cache_model("individual", "individual.Individual", preheat=False, validity=False)
+register_cache_model("individual_data_source", "individual.IndividualDataSource", preheat=False, validity=False)
+register_cache_model("individual_data_source_upload", "individual.IndividualDataSourceUpload", preheat=False,
+                     validity=False)
+register_cache_model("group", "individual.Group", preheat=False, validity=False)
+register_cache_model("group_individual", "individual.GroupIndividual", preheat=False, validity=False)
+register_cache_model("cheque_import", "cs.ChequeImport", preheat=False, validity=False)
+register_cache_model("cheque_import_line", "cs.ChequeImportLine", preheat=False, validity=False)
+register_cache_model("cheque_updated_history", "cs.ChequeUpdatedHistory", preheat=False, validity=False)
@@ -1,25 +1,66 @@
 import logging
 import graphene
-from django.core.cache import caches
-from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 logger = logging.getLogger(__name__)
-from django.core.exceptions import ValidationError
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.utils.translation import gettext as _
 from core.schema import OpenIMISMutation
 # from policy.models import clean_all_enquire_cache_product
-from django.db.models import Q
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.jobs import PreheatJobService
 from cache_manager.services import CacheService
-from django.utils.translation import gettext as _
 
 class CacheInfoType(graphene.ObjectType):
     cache_name = graphene.String()
     model = graphene.String(required=False)
     total_count = graphene.Int()
     max_item_count = graphene.Int()
+    total_bytes = graphene.Float()
+    count_strategy = graphene.String()
+    count_computed_at = graphene.DateTime()
+    hit_ratio = graphene.Float()
+    miss_rate = graphene.Float()
+    get_latency_p50 = graphene.Float()
+    get_latency_p99 = graphene.Float()
 
     class Meta:
-        fields = ("cache_name", "model", "total_count", "max_item_count")
+        fields = ("cache_name", "model", "total_count", "max_item_count", "total_bytes", "count_strategy",
+                  "count_computed_at", "hit_ratio", "miss_rate", "get_latency_p50", "get_latency_p99")
+
+class PreheatModelProgressType(graphene.ObjectType):
+    model = graphene.String()
+    status = graphene.String()
+    rows_loaded = graphene.Int()
+    keys_written = graphene.Int()
+    total_rows = graphene.Int()
+    elapsed = graphene.Float()
+    error = graphene.String()
+
+class PreheatJobType(graphene.ObjectType):
+    job_id = graphene.String()
+    status = graphene.String()
+    incremental = graphene.Boolean()
+    batch_size = graphene.Int()
+    models = graphene.List(PreheatModelProgressType)
+    rows_loaded = graphene.Int()
+    keys_written = graphene.Int()
+    total_rows = graphene.Int()
+    throughput = graphene.Float()
+    eta_seconds = graphene.Float()
+    started_at = graphene.DateTime()
+    updated_at = graphene.DateTime()
+    finished_at = graphene.DateTime()
+    error = graphene.String()
+
+class PayloadSizesType(graphene.ObjectType):
+    model = graphene.String()
+    sampled = graphene.Int()
+    items_count = graphene.Int()
+    pickle_bytes_per_entry = graphene.Float()
+    compact_bytes_per_entry = graphene.Float()
+    pickle_total_bytes = graphene.Float()
+    compact_total_bytes = graphene.Float()
+    cached_total_bytes = graphene.Float()
 
 class PageInfoType(graphene.ObjectType):
     has_next_page = graphene.Boolean()
@@ -46,38 +87,61 @@ class Query(graphene.ObjectType):
         last=graphene.Int(),
         after=graphene.String(),
         before=graphene.String(),
+        with_sizes=graphene.Boolean(required=False),
+    )
+    preheat_job = graphene.Field(
+        PreheatJobType,
+        job_id=graphene.String(required=True),
+    )
+
+    cache_payload_sizes = graphene.Field(
+        PayloadSizesType,
+        model=graphene.String(required=True),
+        sample_size=graphene.Int(required=False),
     )
 
-    def resolve_cache_info(self, info, model=None, order_by=None, first=10, last=None, after=None, before=None):
+    def resolve_cache_payload_sizes(self, info, model, sample_size=1000):
+        if info.context.user.is_anonymous:
+            raise PermissionDenied(_("unauthorized"))
+        return PayloadSizesType(**CacheService.measure_payload_sizes(model.lower(), sample_size))
+
+    def resolve_preheat_job(self, info, job_id):
+        if info.context.user.is_anonymous:
+            raise PermissionDenied(_("unauthorized"))
+        job = PreheatJobService.get(job_id)
+        if not job:
+            return None
+        return PreheatJobType(**{**job, "models": [PreheatModelProgressType(**model) for model in job["models"]]})
+
+    def resolve_cache_info(self, info, model=None, order_by=None, first=10, last=None, after=None, before=None,
+                           with_sizes=False):
         openimis_models = CacheService.openimis_models
-                
+        if CacheManagerConfig.key_index_enabled and not with_sizes:
+            census = CacheService.index_census(openimis_models)
+        else:
+            # the keyspace is walked once for all the models
+            census = CacheService.keyspace_census(openimis_models, with_sizes=with_sizes)
+
+        stats = CacheService.get_cache_stats(openimis_models) if CacheManagerConfig.stats_enabled else {}
+
         cache_info_list = []
         for model in openimis_models:
             model = model.lower()
-            if model == "location_user":
-                cache = caches['location']
-                cache_config = settings.CACHES.get('location')
-            elif model in settings.CACHES and model != 'location':
-                cache = caches[model]
-                cache_config = settings.CACHES.get(model, settings.CACHES['default'])
-            else:
-                cache = caches['default']
-                cache_config = settings.CACHES['default']
-
-            redis_client = cache.client.get_client()
-            redis_client.select(0)
-            prefix = cache_config.get('KEY_PREFIX', '')
-            if cache_config == settings.CACHES['default']:
-                prefix = CacheService.get_prefixed_model(model)
-            key_count = sum(1 for _ in redis_client.scan_iter(match=f'{prefix}*', count=100000))
-
-            max_item_count = CacheService.items_count(model)
-            total_count = key_count
+            items_count = CacheService.items_count_info(model)
+            model_stats = stats.get(model, {})
+            total_count = census[model]["count"]
             cache_info_list.append(CacheInfoType(
                 cache_name=model,
                 model=model,
-                max_item_count=max_item_count,
-                total_count=total_count
+                max_item_count=items_count["count"],
+                total_count=total_count,
+                total_bytes=census[model]["bytes"] if with_sizes else None,
+                count_strategy=items_count["strategy"],
+                count_computed_at=items_count["computed_at"],
+                hit_ratio=model_stats.get("hit_ratio"),
+                miss_rate=model_stats.get("miss_rate"),
+                get_latency_p50=model_stats.get("get_latency_p50"),
+                get_latency_p99=model_stats.get("get_latency_p99")
             ))
 
         total_count = len(cache_info_list)
@@ -138,7 +202,6 @@ class ClearCacheMutation(OpenIMISMutation):
 
     @classmethod
     def async_mutate(cls, user, **data):
-        openimis_models = CacheService.openimis_models
         try:
             if type(user) is AnonymousUser or not user.id:
                 raise ValidationError(_("mutation.authentication_required"))
@@ -149,23 +212,10 @@ class ClearCacheMutation(OpenIMISMutation):
 
             for model in models:
                 model = model.lower()
-                if model in caches or model == "location_user":
-                    # cache = caches['location'] if model == "location_user" else caches[model]
-                    match model:
-                        case "location_user":
-                            # free_cache_for_user(user.id)
-                            CacheService.clear_module_cache("location")
-                        case "coverage":
-                            # clean_all_enquire_cache_product()
-                            CacheService.clear_module_cache(model)
-                        case "location":
-                            CacheService.clear_all_model_cache(model)
-                        case _:
-                            raise ValidationError(_("model_does_not_define"))
-                elif model in openimis_models:
-                    CacheService.clear_all_model_cache(model)
-                else:
-                    raise ValidationError(_(f"The cache for model '{model}' does not exist."))
+                result = CacheService.clear_cache(model)
+                if result:
+                    logger.info("Cleared %s keys from the %s cache in %.3fs",
+                                result["removed_keys"], model, result["elapsed"])
             return None 
         except Exception as exc:
             return [
@@ -176,12 +226,43 @@ class ClearCacheMutation(OpenIMISMutation):
                 }
             ]
 
+class RecountCacheMutation(OpenIMISMutation):
+    _mutation_module = "cache_manager"
+    _mutation_class = "RecountCacheMutation"
+
+    class Input(OpenIMISMutation.Input):
+        models = graphene.List(graphene.String)
+
+    @classmethod
+    def async_mutate(cls, user, **data):
+        try:
+            if type(user) is AnonymousUser or not user.id:
+                raise ValidationError(_("mutation.authentication_required"))
+            models = [model.lower() for model in data.get("models", None) or []]
+            unsupported = [model for model in models if model not in CacheService.openimis_models]
+            if unsupported:
+                raise ValidationError(_(f"The cache for model '{unsupported[0]}' does not exist."))
+
+            counts = CacheService.rebuild_key_index(models or None)
+            logger.info("Rebuilt the cache key index: %s", counts)
+            return None
+        except Exception as exc:
+            return [
+                {
+                    "message": _("cache_manager.mutation.failed_to_recount_cache")
+                    % {"models": str(data.get("models"))},
+                    "detail": str(exc),
+                }
+            ]
+
 class PreheatCacheMutation(OpenIMISMutation):
     _mutation_module = "cache_manager"
     _mutation_class = "PreheatCacheMutation"
 
     class Input(OpenIMISMutation.Input):
-        model = graphene.String(required=True)
+        model = graphene.String(required=False)
+        models = graphene.List(graphene.String, required=False)
+        incremental = graphene.Boolean(required=False)
 
     @classmethod
     def async_mutate(cls, user, **data):
@@ -189,20 +270,57 @@ class PreheatCacheMutation(OpenIMISMutation):
             if user.is_anonymous or not user.id:
                 raise ValidationError(_("authentication_required"))
             
-            model = data.get("model")
-            if not model:
+            models = data.get("models") or ([data["model"]] if data.get("model") else [])
+            if not models:
                 raise ValidationError(_("Model_cannot_be_null"))
+            try:
+                models = PreheatJobService.get_models(models)
+            except ValueError:
+                raise ValidationError(_("Unsupported_model_for_cache_preheating"))
 
-            result = CacheService.preload_model_cache(model, user)
-            
-            if result:
+            # the client mutation id is the job id to poll with the preheatJob query
+            if CacheManagerConfig.preheat_in_background and not data.get("client_mutation_id"):
+                raise ValidationError(_("Client_mutation_id_required_for_preheat_job"))
+            job = PreheatJobService.create(models, job_id=data.get("client_mutation_id"),
+                                           incremental=bool(data.get("incremental")))
+            if CacheManagerConfig.preheat_in_background:
+                PreheatJobService.start_created(job, user)
+                logger.info("Started preheat job %s of %s", job["job_id"], ", ".join(models))
+                return None
+
+            job = PreheatJobService.run(job, user)
+            if job["status"] == PreheatJobService.STATUS_DONE:
                 return None 
             else:
-                raise ValidationError(_("Failed_to_preheat_the_cache."))
+                raise ValidationError(_("Failed_to_preheat_the_cache.") + (job["error"] or ""))
+        except Exception as exc:
+            return [
+                {
+                    "message": _("Failed_to_preheat_cache_for_model:") + str(data.get("models") or data.get("model")),
+                    "detail": str(exc),
+                }
+            ]
+
+class CancelPreheatJobMutation(OpenIMISMutation):
+    _mutation_module = "cache_manager"
+    _mutation_class = "CancelPreheatJobMutation"
+
+    class Input(OpenIMISMutation.Input):
+        job_id = graphene.String(required=True)
+
+    @classmethod
+    def async_mutate(cls, user, **data):
+        try:
+            if user.is_anonymous or not user.id:
+                raise ValidationError(_("authentication_required"))
+
+            if not PreheatJobService.cancel(data["job_id"]):
+                raise ValidationError(_("Preheat_job_not_found_or_finished"))
+            return None
         except Exception as exc:
             return [
                 {
-                    "message": _("Failed_to_preheat_cache_for_model:") + str(data["model"]),
+                    "message": _("Failed_to_cancel_preheat_job:") + str(data["job_id"]),
                     "detail": str(exc),
                 }
             ]
@@ -210,3 +328,5 @@ class PreheatCacheMutation(OpenIMISMutation):
 class Mutation(graphene.ObjectType):
     clear_cache = ClearCacheMutation.Field()
     preheat_cache = PreheatCacheMutation.Field()
+    recount_cache = RecountCacheMutation.Field()
+    cancel_preheat_job = CancelPreheatJobMutation.Field()
@@ -0,0 +1,116 @@
+"""
+Lua scripts walking the keyspace inside Redis, so that counting or removing the keys of a model only sends a cursor
+and totals over the network instead of every key name. Each call runs one SCAN slice of a bounded number of keys,
+so that Redis is never blocked for long, and the scripts are sent once then called with EVALSHA.
+Writing after SCAN in a script requires Redis 5 (effects replication), the callers fall back to pipelines otherwise.
+"""
+import time
+
+from cache_manager.apps import CacheManagerConfig
+
+# KEYS: none, ARGV: cursor, MATCH pattern, COUNT hint, UNLINK chunk size
+# returns {next cursor, number of removed keys}
+UNLINK_SLICE_SCRIPT = """
+local result = redis.call('SCAN', ARGV[1], 'MATCH', ARGV[2], 'COUNT', ARGV[3])
+local keys = result[2]
+local chunk = tonumber(ARGV[4])
+local removed = 0
+for i = 1, #keys, chunk do
+    removed = removed + redis.call('UNLINK', unpack(keys, i, math.min(i + chunk - 1, #keys)))
+end
+return {result[1], removed}
+"""
+
+# KEYS: none, ARGV: cursor, COUNT hint, number of classes, (class name, generation or '') of each class,
+# number of prefixes, each prefix
+# returns {next cursor, {count of each class..., count of each prefix...}}
+CENSUS_SLICE_SCRIPT = """
+local n = tonumber(ARGV[3])
+local classes = {}
+for i = 1, n do
+    classes[ARGV[2 + 2 * i]] = {i, ARGV[3 + 2 * i]}
+end
+local m = tonumber(ARGV[4 + 2 * n])
+local prefixes = {}
+for j = 1, m do
+    prefixes[j] = ARGV[4 + 2 * n + j]
+end
+local counts = {}
+for i = 1, n + m do
+    counts[i] = 0
+end
+local result = redis.call('SCAN', ARGV[1], 'COUNT', ARGV[2])
+for _, key in ipairs(result[2]) do
+    local class, rest = string.match(key, '^oi:1:cs_(%w+)_(.*)$')
+    local entry = class and classes[class]
+    if entry then
+        if entry[2] == '' or string.sub(rest, 1, #entry[2] + 2) == 'g' .. entry[2] .. '_' then
+            counts[entry[1]] = counts[entry[1]] + 1
+        end
+    else
+        for j = 1, m do
+            if string.sub(key, 1, #prefixes[j]) == prefixes[j] then
+                counts[n + j] = counts[n + j] + 1
+                break
+            end
+        end
+    end
+end
+return {result[1], counts}
+"""
+
+# KEYS: lock key, ARGV: value of the owner
+# returns 1 when the lock was released, 0 when it expired or is held by another owner
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def release_lock(redis_client, key, owner):
+    """
+    Deletes the lock key only if it is still held by the owner (its value as stored in Redis).
+    """
+    return redis_client.register_script(RELEASE_LOCK_SCRIPT)(keys=[key], args=[owner])
+
+
+def unlink_prefix_slices(redis_client, prefix, count, pause=0, chunk_size=500):
+    """
+    Removes the keys matching the prefix with the UNLINK_SLICE_SCRIPT, one SCAN slice of about count keys per call.
+    Yields the number of keys removed by each slice.
+    """
+    script = redis_client.register_script(UNLINK_SLICE_SCRIPT)
+    cursor = 0
+    while True:
+        cursor, removed = script(args=[cursor, f"{prefix}*", count, chunk_size])
+        yield removed
+        if int(cursor) == 0:
+            return
+        if pause:
+            time.sleep(pause)
+
+
+def census_slices(redis_client, classes, prefixes):
+    """
+    Counts the keys of each model with the CENSUS_SLICE_SCRIPT, classes and prefixes being those of
+    cache_manager.services.get_key_model. Returns {model: count}.
+    """
+    script = redis_client.register_script(CENSUS_SLICE_SCRIPT)
+    class_names = list(classes)
+    args = [CacheManagerConfig.scan_count, len(class_names)]
+    for class_name in class_names:
+        generation = classes[class_name][1]
+        args += [class_name, "" if generation is None else generation]
+    args += [len(prefixes), *[prefix for prefix, _ in prefixes]]
+    buckets = [classes[class_name][0] for class_name in class_names] + [model for _, model in prefixes]
+
+    counts = dict.fromkeys(buckets, 0)
+    cursor = 0
+    while True:
+        cursor, slice_counts = script(args=[cursor, *args])
+        for model, count in zip(buckets, slice_counts):
+            counts[model] += count
+        if int(cursor) == 0:
+            return counts
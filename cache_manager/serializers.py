@@ -0,0 +1,161 @@
+"""
+Compact encoding of the preloaded payloads. The payload of a model is stored as the list of its values in the order
+of its registered projection (the field names are not repeated in each entry), packed with msgpack when it is
+installed or pickled as a tuple otherwise, and compressed with zlib above compact_compress_threshold bytes.
+Encoded entries start with a marker, so that CompactSerializer decodes them transparently on read and handles any
+other value like the default django-redis pickle serializer. An entry that cannot be decoded, e.g. written with the
+layout of a projection changed since, raises UndecodableEntryError, read as a cache miss by CacheManagerRedisCache.
+"""
+import datetime
+import decimal
+import logging
+import pickle
+import struct
+import uuid
+import zlib
+
+from django_redis.serializers.pickle import PickleSerializer
+
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.registry import get_preload_projection, get_preload_projections, get_registry_version
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MARKER = b"\x00CM"
+HEADER = struct.Struct(">BI")
+FLAG_MSGPACK = 1
+FLAG_ZLIB = 2
+
+EXT_DECIMAL = 1
+EXT_DATE = 2
+EXT_DATETIME = 3
+EXT_UUID = 4
+
+
+
+class UndecodableEntryError(ValueError):
+    """
+    Raised when a compact entry cannot be decoded.
+    """
+
+
+_layouts = {}
+# layouts not matching any registered projection, not looked up again on each read until the next registration
+_unknown_layouts = set()
+_unknown_layouts_version = None
+
+
+def get_layout(model):
+    """
+    Returns the id and the field names of the layout of the payloads of the model.
+    """
+    projection = get_preload_projection(model)
+    names = projection["fields"] + tuple(projection["related"])
+    return zlib.crc32(f"{model}:{','.join(names)}".encode()), names
+
+
+def get_layout_names(layout_id):
+    global _unknown_layouts_version
+    if _unknown_layouts_version != get_registry_version():
+        _unknown_layouts.clear()
+        _unknown_layouts_version = get_registry_version()
+    if layout_id not in _layouts and layout_id not in _unknown_layouts:
+        from cache_manager.services import CacheService
+        for model in {*get_preload_projections(), *CacheService.openimis_models}:
+            model_layout_id, names = get_layout(model)
+            _layouts[model_layout_id] = names
+    if layout_id not in _layouts:
+        _unknown_layouts.add(layout_id)
+        raise ValueError(f"Unknown cache payload layout {layout_id}")
+    return _layouts[layout_id]
+
+
+def encode_payload(model, payload):
+    """
+    Encodes a preloaded payload of the model into its compact form.
+    """
+    layout_id, names = get_layout(model)
+    _layouts[layout_id] = names
+    values = [payload.get(name) for name in names]
+    if msgpack:
+        flags = FLAG_MSGPACK
+        body = msgpack.packb(values, default=encode_ext, use_bin_type=True)
+    else:
+        flags = 0
+        body = pickle.dumps(tuple(values), protocol=pickle.HIGHEST_PROTOCOL)
+    if len(body) > CacheManagerConfig.compact_compress_threshold:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            flags |= FLAG_ZLIB
+            body = compressed
+    return MARKER + HEADER.pack(flags, layout_id) + body
+
+
+def decode_payload(data):
+    """
+    Decodes a compact entry back into its payload dict.
+    """
+    flags, layout_id = HEADER.unpack_from(data, len(MARKER))
+    names = get_layout_names(layout_id)
+    body = data[len(MARKER) + HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    if flags & FLAG_MSGPACK:
+        values = msgpack.unpackb(body, ext_hook=decode_ext, raw=False)
+    else:
+        values = pickle.loads(body)
+    return dict(zip(names, values))
+
+
+def is_compact(data):
+    return isinstance(data, (bytes, bytearray)) and data[:len(MARKER)] == MARKER
+
+
+def encode_ext(value):
+    if isinstance(value, decimal.Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(value).encode())
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, value.isoformat().encode())
+    if isinstance(value, datetime.date):
+        return msgpack.ExtType(EXT_DATE, value.isoformat().encode())
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, value.bytes)
+    raise TypeError(f"Cannot encode {type(value)} in a compact cache payload")
+
+
+def decode_ext(code, data):
+    if code == EXT_DECIMAL:
+        return decimal.Decimal(data.decode())
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    if code == EXT_DATE:
+        return datetime.date.fromisoformat(data.decode())
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+class CompactSerializer(PickleSerializer):
+    """
+    django-redis serializer storing compact payloads as they are and decoding them on read, other values are
+    pickled. Set it as SERIALIZER in the OPTIONS of the default cache to enable compact_encoding.
+    """
+
+    def dumps(self, value):
+        if is_compact(value):
+            return bytes(value)
+        return super().dumps(value)
+
+    def loads(self, value):
+        if is_compact(value):
+            try:
+                return decode_payload(value)
+            except (ValueError, struct.error, zlib.error, pickle.UnpicklingError) as exc:
+                logger.warning("Cannot decode a compact cache entry: %s", exc)
+                raise UndecodableEntryError(str(exc)) from exc
+        return super().loads(value)
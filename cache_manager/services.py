@@ -1,24 +1,36 @@
 # services.py
-from django.db import models
+import logging
+import pickle
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext as _
 from django.core.cache import caches
 from django.conf import settings
-from location.models import Location, HealthFacility, UserDistrict, OfficerVillage
-from insuree.models import InsureePolicy
-from claim.models import (ClaimDedRem, Claim, ClaimAdmin, Feedback, ClaimItem, ClaimService, ClaimAttachment,
-                          ClaimAttachmentType, FeedbackPrompt)
-from insuree.models import Insuree, InsureePhoto, Family, InsureePolicy, InsureeStatusReason
-from individual.models import Individual, IndividualDataSource, Group, GroupIndividual, IndividualDataSourceUpload
-from medical.models import Diagnosis, Item, Service
-from policy.models import Policy, PolicyRenewal
-from product.models import Product, ProductService
-from tools.models import Extract
-from contribution.models import Premium
-from cs.models import ChequeImport, ChequeImportLine, ChequeUpdatedHistory
-from core.models import Role, User, RoleRight, InteractiveUser, UserRole, Officer
-from django.db.models import QuerySet
+from django.db import connection
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.db.models import Q, QuerySet
+from redis.exceptions import ResponseError
+try:
+    from redis.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None
 from core.utils import get_cache_key
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.local_cache import broadcast_invalidation
+from cache_manager.registry import (CacheModels, get_cache_model, get_cache_model_options, get_preload_projection,
+                                    get_registry_version)
+from cache_manager.scripts import census_slices, unlink_prefix_slices
+from cache_manager.serializers import CompactSerializer, encode_payload
+from cache_manager.stats import get_stats_key, summarize_stats
+from cache_manager.throttle import get_throttle
+
+logger = logging.getLogger(__name__)
 
 
 class CacheService:
@@ -31,39 +43,36 @@ class CacheService:
     def clear_all_model_cache(model):
         cache = caches['default']
         redis_client = cache.client.get_client()
-        redis_client.select(0)
         if model and model in CacheService.openimis_models:
-            prefix = CacheService.get_prefixed_model(model)
-            keys = redis_client.scan_iter(match=f'{prefix}*', count=10000)
-
-            for key in keys:
-                key_str = key.decode('utf-8')
-                redis_client.delete(key_str)
-            return None
+            if CacheManagerConfig.model_cache_versioning:
+                result = CacheService.bump_model_generation(model)
+            else:
+                prefix = CacheService.get_prefixed_model(model)
+                result = unlink_keys_by_prefix(redis_client, prefix)
+                redis_client.unlink(get_index_key(model))
+                delete_preload_watermarks(model)
+            broadcast_invalidation(redis_client, models=[model])
+            return result
 
     @staticmethod
     def clear_module_cache(model):
         cache = caches[model]
         redis_client = cache.client.get_client()
-        redis_client.select(0)
         if model and model in CacheService.cache_modules:
             cache_config = settings.CACHES[model]
             prefix = cache_config.get('KEY_PREFIX', '')
-            keys = redis_client.scan_iter(match=f'{prefix}*', count=10000)
-
-            for key in keys:
-                key_str = key.decode('utf-8')
-                redis_client.delete(key_str)
-            return None
+            result = unlink_keys_by_prefix(redis_client, prefix)
+            module_models = CacheService.get_module_models(model)
+            unlink_keys(redis_client, [get_index_key(module_model) for module_model in module_models],
+                        per_key=is_cluster_client(redis_client))
+            delete_preload_watermarks(*module_models)
+            broadcast_invalidation(redis_client, models=module_models)
+            return result
 
     cache_modules = {'location', 'coverage'}
 
-    openimis_models = {'location_user', 'coverage', 'claim_admin', 'claim', 'claim_item', 'claim_attachment_type', 'claim_attachment',
-                   'claim_service','claim_ded_rem', 'premium', 'role', 'role_right', 'interactive_user', 'user_role', 'user', 'officer', 
-                   'insuree_photo', 'family', 'insuree', 'insuree_policy', 'health_facility', 'user_district', 'location', 'officer_village', 
-                   'feedback_prompt', 'diagnosis', 'item', 'service', 'policy', 'policy_renewal', 'product', 'product_service', 'extract'}
-    #'individual', 'individual_data_source_upload', 'individual_data_source', 'group', 'group_individual', 'history_business_model', 
-    # 'cheque_import', 'cheque_import_line', 'cheque_updated_history', 'product_item','feedback', 'policy_renewal_detail', 'insuree_status_reason',  
+    # the names of the supported models, see cache_manager.registry
+    openimis_models = CacheModels()
 
     @staticmethod
     def get_prefixed_model(model):
@@ -72,108 +81,323 @@ class CacheService:
         """
 
         model_class, _ = CacheService.get_model_class(model)
-        prefix = f"oi:1:cs_{model_class.__name__}_"
-        
-        return prefix
+        if CacheManagerConfig.model_cache_versioning:
+            return get_generation_prefix(model_class, get_model_generation(model_class))
+        return f"oi:1:cs_{model_class.__name__}_"
+
+    @staticmethod
+    def get_model_cache_alias(model):
+        """
+        Returns the alias of the cache holding the entries of the model.
+        """
+        if model == "location_user":
+            return 'location'
+        elif model in settings.CACHES and model != 'location':
+            return model
+        return 'default'
+
+    @staticmethod
+    def get_model_cache(model):
+        """
+        Returns the alias of the cache holding the entries of the model and the prefix of their keys.
+        """
+        alias = CacheService.get_model_cache_alias(model)
+        if alias == 'default':
+            return alias, CacheService.get_prefixed_model(model)
+        return alias, settings.CACHES[alias].get('KEY_PREFIX', '')
+
+    @staticmethod
+    def get_module_models(alias):
+        """
+        Returns the supported models whose entries are stored in the given module cache.
+        """
+        return [model for model in CacheService.openimis_models if CacheService.get_model_cache_alias(model) == alias]
+
+    @staticmethod
+    def clear_cache(model):
+        """
+        Clears the cache of a model: the module cache of location_user and coverage, the model cache otherwise.
+        Returns {"removed_keys", "elapsed"}.
+        """
+        if model == "location_user":
+            return CacheService.clear_module_cache("location")
+        if model == "coverage":
+            return CacheService.clear_module_cache(model)
+        if model in CacheService.openimis_models:
+            return CacheService.clear_all_model_cache(model)
+        raise ValidationError(_(f"The cache for model '{model}' does not exist."))
+
+    @staticmethod
+    def get_model_servers(models):
+        """
+        Groups the models by the Redis server (or cluster) holding their cache entries, with the class names
+        (and generations) of the model caches and the key prefixes of the module caches.
+        """
+        servers = {}
+        for model in models:
+            alias, prefix = CacheService.get_model_cache(model)
+            redis_client = caches[alias].client.get_client()
+            server = servers.setdefault(get_client_identity(redis_client),
+                                        {"client": redis_client, "classes": {}, "prefixes": []})
+            if alias == 'default':
+                model_class, _ = CacheService.get_model_class(model)
+                generation = get_model_generation(model_class) if CacheManagerConfig.model_cache_versioning else None
+                server["classes"][model_class.__name__] = (model, generation)
+            else:
+                server["prefixes"].append((prefix, model))
+        return servers.values()
+
+    @staticmethod
+    def keyspace_census(models=None, with_sizes=False):
+        """
+        Counts the cached entries of all the given models (all the supported ones by default) while
+        walking the keyspace of each Redis server only once. Model cache keys are bucketed by their
+        cs_<Model>_ prefix, module cache keys by the KEY_PREFIX of their cache. With with_sizes, the
+        memory used by the keys is also summed up.
+        Returns a dict of {model: {"count": ..., "bytes": ...}}.
+        """
+        models = models or CacheService.openimis_models
+        census = {model: {"count": 0, "bytes": 0} for model in models}
+        for server in CacheService.get_model_servers(models):
+            census_keyspace(server["client"], server["classes"], server["prefixes"], census, with_sizes)
+        return census
+
+    @staticmethod
+    def index_census(models=None):
+        """
+        Counts the cached entries of the given models from the key index maintained on writes,
+        without scanning the keyspace. Returns the same structure as keyspace_census, without sizes.
+        The entries of the models with a TTL are not indexed, they are counted by a walk of the keyspace.
+        """
+        models = models or CacheService.openimis_models
+        expiring = [model for model in models if not is_indexed_model(model)]
+        census = CacheService.keyspace_census(expiring) if expiring else {}
+        for server in CacheService.get_model_servers([model for model in models if is_indexed_model(model)]):
+            server_models = [model for model, _ in server["classes"].values()]
+            server_models += [model for _, model in server["prefixes"]]
+            pipeline = server["client"].pipeline(transaction=False)
+            for model in server_models:
+                pipeline.scard(get_index_key(model))
+            for model, count in zip(server_models, pipeline.execute()):
+                census[model] = {"count": count, "bytes": 0}
+        return census
+
+    @staticmethod
+    def get_cache_stats(models=None):
+        """
+        Returns the hit ratio, miss rate and get latency percentiles recorded for each of the given models
+        by the CacheManagerRedisCache backends.
+        """
+        models = list(models or CacheService.openimis_models)
+        pipeline = caches['default'].client.get_client().pipeline(transaction=False)
+        for model in models:
+            pipeline.hgetall(get_stats_key(model))
+        return {model: summarize_stats(raw_stats) for model, raw_stats in zip(models, pipeline.execute())}
+
+    @staticmethod
+    def rebuild_key_index(models=None):
+        """
+        Rebuilds the key index of the given models (all the supported ones by default) from a walk of
+        the keyspace, when it drifted from the actual cache content. The new index of each model is
+        built aside and swapped atomically. The nodes of a Redis Cluster are walked in parallel.
+        Returns the number of indexed keys per model.
+        """
+        models = models or CacheService.openimis_models
+        counts = {}
+        for server in CacheService.get_model_servers(models):
+            redis_client = server["client"]
+            server_models = [model for model, _ in server["classes"].values()]
+            server_models += [model for _, model in server["prefixes"]]
+            unlink_keys(redis_client, [get_index_key(model, rebuilding=True) for model in server_models],
+                        per_key=is_cluster_client(redis_client))
+            counts.update({model: 0 for model in server_models})
+
+            def index_node_keys(node_client):
+                node_counts = dict.fromkeys(server_models, 0)
+                batch = []
+                for key, model in iter_model_keys(node_client, server["classes"], server["prefixes"]):
+                    batch.append((key, model))
+                    node_counts[model] += 1
+                    if len(batch) >= CacheManagerConfig.clear_batch_size:
+                        add_index_members(redis_client, batch, rebuilding=True)
+                        batch = []
+                if batch:
+                    add_index_members(redis_client, batch, rebuilding=True)
+                return node_counts
+
+            for node_counts in fan_out(redis_client, index_node_keys):
+                for model, count in node_counts.items():
+                    counts[model] += count
+            pipeline = redis_client.pipeline(transaction=False)
+            for model in server_models:
+                if counts[model] and is_indexed_model(model):
+                    pipeline.rename(get_index_key(model, rebuilding=True), get_index_key(model))
+                else:
+                    pipeline.unlink(get_index_key(model))
+            pipeline.execute()
+        return counts
+
+    @staticmethod
+    def bump_model_generation(model):
+        """
+        Invalidates the whole cache of the model in constant time by incrementing its generation.
+        The keys of the previous generation are no longer read, they expire with their TTL or are
+        removed by a low priority background sweeper. The other processes may write keys of the previous generation
+        until they read the new one, within generation_cache_ttl, the sweep therefore starts after twice that delay.
+        """
+        started = time.monotonic()
+        model_class, _ = CacheService.get_model_class(model)
+        redis_client = caches['default'].client.get_client()
+        generation = redis_client.incr(get_generation_key(model_class))
+        _model_generations[model_class.__name__] = (generation, time.monotonic())
+        redis_client.unlink(get_index_key(model))
+        if CacheManagerConfig.sweep_old_generations:
+            sweep_keys_by_prefix(redis_client, get_generation_prefix(model_class, generation - 1),
+                                 delay=2 * CacheManagerConfig.generation_cache_ttl)
+        return {"removed_keys": 0, "generation": generation, "elapsed": time.monotonic() - started}
 
+    @staticmethod
     def items_count(model):
-            match model:              
-                    case "cheque_import":
-                        valid_items_count = ChequeImport.objects.filter().count()
-                    case "cheque_import_line":
-                        valid_items_count = ChequeImportLine.objects.filter().count()
-                    case "cheque_updated_history":
-                        valid_items_count = ChequeUpdatedHistory.objects.filter().count()
-                    case "individual":
-                        valid_items_count = Individual.objects.filter().count()
-                    case "individual_data_source_upload":
-                        valid_items_count = IndividualDataSourceUpload.objects.filter().count()
-                    case "individual_data_source":
-                        valid_items_count = IndividualDataSource.objects.filter().count()
-                    case "group":
-                        valid_items_count = Group.objects.filter().count()
-                    case "group_individual":
-                        valid_items_count = GroupIndividual.objects.filter().count()  
-                    case "location_user":
-                        valid_items_count = Location.objects.filter(validity_to__isnull=True).count() + 3      
-                    case _:
-                        model_class, _ = CacheService.get_model_class(model)
-                        valid_items_count = model_class.objects.filter(validity_to__isnull=True).count()
-            return valid_items_count
+        options = get_cache_model_options(model)
+        if options["count"]:
+            return import_string(options["count"])()
+        model_class, _ = CacheService.get_model_class(model)
+        queryset = model_class.objects.filter(validity_to__isnull=True) if options["validity"] else model_class.objects
+        return queryset.count()
+
+    @staticmethod
+    def items_count_info(model):
+        """
+        Returns the number of valid items of the model computed with the configured item_count_strategy:
+        - exact: COUNT(*) of the valid rows on each call
+        - estimate: the row count estimated by the database planner (PostgreSQL and SQL Server), it includes
+          the historical rows and falls back to exact on other databases
+        - cached: the exact count kept in cache, refreshed in background once older than item_count_ttl
+        Returns a dict with the count, the strategy that produced it and the date it was computed.
+        """
+        strategy = CacheManagerConfig.item_count_strategy
+        if strategy == "estimate":
+            count = estimate_items_count(model)
+            if count is not None:
+                return {"count": count, "strategy": "estimate", "computed_at": timezone.now()}
+        elif strategy == "cached":
+            return get_cached_items_count(model)
+        return {"count": CacheService.items_count(model), "strategy": "exact", "computed_at": timezone.now()}
 
 
     @staticmethod
     def get_model_class(model):
         """
-        Returns the corresponding Django model class based on the model name.
-        """
-        model_classes = {
-            'location': Location,
-            'claim_admin': ClaimAdmin,
-            'feedback': Feedback,
-            'claim': Claim,
-            'feedback_prompt': FeedbackPrompt,
-            'claim_item': ClaimItem,
-            'claim_attachment_type': ClaimAttachmentType,
-            'claim_attachment': ClaimAttachment,
-            'claim_service': ClaimService,
-            'claim_ded_rem': ClaimDedRem,
-            'premium': Premium,
-            'role': Role,
-            'role_right': RoleRight,
-            'interactive_user': InteractiveUser,
-            'user_role': UserRole,
-            'user': User,
-            'officer': Officer,
-            'insuree_photo': InsureePhoto,
-            'family': Family,
-            'insuree_status_reason': InsureeStatusReason,
-            'insuree': Insuree,
-            'insuree_policy': InsureePolicy,
-            'health_facility': HealthFacility,
-            'user_district': UserDistrict,
-            'officer_village': OfficerVillage,
-            'diagnosis': Diagnosis,
-            'item': Item,
-            'service': Service,
-            'policy': Policy,
-            'policy_renewal': PolicyRenewal,
-            'product': Product,
-            'product_service': ProductService,
-            'extract': Extract
-        }
+        Returns the corresponding Django model class based on the model name, and whether its entries are stored
+        one per row (False for the module caches).
+        """
+        try:
+            return get_cache_model(model)
+        except LookupError:
+            raise ValidationError(_("Model_not_found_for_preloading"))
 
-        cache_modules = {
-            'location_user': Location,
-            'coverage': InsureePolicy,
-        }
+    @staticmethod
+    def sync_model_rows(model, refreshed_ids=(), evicted_keys=()):
+        """
+        Rewrites the cache entries of the given rows of the model with a fresh payload, or evicts them when
+        the rows are no longer valid, and evicts the given keys; each through one pipeline per batch.
+        Returns the number of written and evicted keys.
+        """
+        model_class, _ = CacheService.get_model_class(model)
+        cache = caches['default']
+        compact = use_compact_encoding(cache)
+        _, columns, _ = get_projection_columns(model)
+        evicted_keys = list(evicted_keys)
+        refreshed_ids = list(refreshed_ids)
+        written = 0
+        for start in range(0, len(refreshed_ids), SYNC_BATCH_SIZE):
+            ids = refreshed_ids[start:start + SYNC_BATCH_SIZE]
+            rows = list(model_class.objects.filter(pk__in=ids, validity_to__isnull=True).values_list(*columns))
+            found = {row[0] for row in rows}
+            evicted_keys += [get_model_cache_key(model_class, id) for id in ids if id not in found]
+            cache_data = build_payload_cache_data(model, model_class, rows, compact)
+            if cache_data:
+                set_preloaded_entries(cache, model, cache_data)
+                index_cache_keys(cache, model, cache_data)
+                written += len(cache_data)
+        evict_cache_keys(cache, model, evicted_keys)
+        return written, len(evicted_keys)
 
-        if model in model_classes:
-            return model_classes[model], True
-        elif model in cache_modules:
-            return cache_modules[model], False
-        else:
-            raise ValidationError(_("Model_not_found_for_preloading"))
+    @staticmethod
+    def refresh_user_districts(user_id):
+        """
+        Rewrites the location_user entry of one interactive user, e.g. after its districts or roles changed.
+        """
+        from cache_manager.location_user import build_single_user_districts_cache_data
+        cache = caches['location']
+        location_types = cache.get("location_types")
+        if location_types is None:
+            location_types = cache_location_hierarchy(cache)
+        cache_data = build_single_user_districts_cache_data(user_id, location_types)
+        set_preloaded_entries(cache, "location_user", cache_data)
+        index_cache_keys(cache, "location_user", cache_data)
+        return cache_data
 
     @staticmethod
-    def preload_model_cache(model, user):
+    def measure_payload_sizes(model, sample_size=1000):
+        """
+        Measures the size of the preloaded payloads of the model on a sample of at most MAX_PAYLOAD_SAMPLE_SIZE rows, pickled (the default
+        serialization) and in the compact encoding, extrapolates the totals to all the valid rows, and reports
+        the memory currently used by the cached keys of the model.
+        """
+        sample_size = min(max(sample_size, 1), MAX_PAYLOAD_SAMPLE_SIZE)
+        model_class, is_model = CacheService.get_model_class(model)
+        if not is_model:
+            raise ValidationError(_("Unsupported_model_for_payload_measurement"))
+        names, columns, _ = get_projection_columns(model)
+        rows = next(chunked_queryset(model_class.objects.filter(validity_to__isnull=True), sample_size, *columns), [])
+        payloads = [dict(zip(names, row)) for row in rows]
+        pickle_bytes = sum(len(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)) for payload in payloads)
+        compact_bytes = sum(len(encode_payload(model, payload)) for payload in payloads)
+        items_count = CacheService.items_count(model)
+        pickle_per_entry = pickle_bytes / len(payloads) if payloads else 0
+        compact_per_entry = compact_bytes / len(payloads) if payloads else 0
+        return {
+            "model": model,
+            "sampled": len(payloads),
+            "items_count": items_count,
+            "pickle_bytes_per_entry": pickle_per_entry,
+            "compact_bytes_per_entry": compact_per_entry,
+            "pickle_total_bytes": pickle_per_entry * items_count,
+            "compact_total_bytes": compact_per_entry * items_count,
+            "cached_total_bytes": CacheService.keyspace_census([model], with_sizes=True)[model]["bytes"],
+        }
+
+    @staticmethod
+    def preload_model_cache(model, user, progress=None, incremental=False, batch_size=None):
         """
         Preheats the cache by loading all the data of the specified model.
+        The optional progress callback is called after each batch with the number of rows loaded and
+        keys written so far; preheating stops when it returns False, in which case False is returned.
+        With incremental, only the rows created or changed since the watermark of the previous preheating
+        are loaded, and the entries of the rows invalidated since then are evicted.
+        The entries expire after the TTL configured for the model in preload_ttls, see set_preloaded_entries.
+        The coverage cache is filled with the per family coverage summaries of cache_manager.coverage, the
+        location cache with the location hierarchy and the districts of every user of cache_manager.location_user.
+        Rows are loaded by batches of batch_size (BATCH_SIZE by default), throttled when throttle_enabled is set.
         """
-        CACHE_TIMEOUT = None
-        BATCH_SIZE = 10000
+        batch_size = batch_size or BATCH_SIZE
         try:
 
             if model not in CacheService.openimis_models:
                 raise ValidationError(_("Unsupported_model_for_cache_preheating"))
 
             model_class, is_model = CacheService.get_model_class(model)
-            if model == "health_facility":
-                all_objects = model_class.objects.filter(validity_to__isnull=True).only(
-                    "id", "uuid", "code", "name", "location_id")
-            else:
-                all_objects = model_class.objects.filter(validity_to__isnull=True).only("id")
+            all_objects = model_class.objects.filter(validity_to__isnull=True)
+            server_side_cursor = CacheManagerConfig.preload_server_side_cursor
+            preload_started_at = timezone.now()
+            watermark = get_preload_watermark(model_class, model) if incremental else None
+            if watermark:
+                all_objects = all_objects.filter(get_delta_filter(model_class, watermark))
+            max_id = watermark["max_id"] if watermark else None
             cache_data = {}
+            rows_loaded = 0
+            keys_written = 0
 
             if is_model:
                 cache = caches['default']
@@ -181,60 +405,688 @@ class CacheService:
                 #     cache_data[get_cache_key(model_class, obj.id)] = obj
 
                 # cache.set_many(cache_data, timeout=CACHE_TIMEOUT)
-                for chunk in chunked_queryset(all_objects, BATCH_SIZE):
-                    if model == "health_facility":
-                        cache_data = {
-                            get_cache_key(model_class, obj.id): {
-                                "id": obj.id,
-                                "uuid": obj.uuid,
-                                "name": obj.name,
-                                "code": obj.code,
-                                "location_id": obj.location_id
-                            }
-                            for obj in chunk
-                        }
-                    else:
-                        cache_data = {
-                            get_cache_key(model_class, obj.id): {"id": obj.id}
-                            for obj in chunk
-                        }
-                    cache.set_many(cache_data, timeout=CACHE_TIMEOUT)
+                names, columns, key = get_projection_columns(model)
+                compact = use_compact_encoding(cache)
+                throttle = get_throttle(cache.client.get_client())
+                if watermark:
+                    for chunk in chunked_queryset(get_invalidated_rows(model_class, watermark), batch_size, *columns):
+                        evict_cache_keys(cache, model, [key(model_class, dict(zip(names, row))) for row in chunk])
+                for chunk in chunked_queryset(all_objects, batch_size, *columns,
+                                              server_side_cursor=server_side_cursor):
+                    cache_data = build_payload_cache_data(model, model_class, chunk, compact)
+                    set_preloaded_entries(cache, model, cache_data)
+                    if throttle:
+                        throttle.wait(len(cache_data), cache_data)
+                    index_cache_keys(cache, model, cache_data)
+                    rows_loaded += len(chunk)
+                    keys_written += len(cache_data)
+                    max_id = max(chunk[-1][0], max_id) if max_id is not None else chunk[-1][0]
+                    if progress and progress(rows_loaded, keys_written) is False:
+                        return False
             else:
                 if model == 'location_user':
-                    # cache = caches['location']
-                    all_objects = UserDistrict.get_user_districts(user)
+                    from cache_manager.location_user import LOCATION_HIERARCHY_ENTRIES, iter_user_districts_cache_data
+                    cache = caches['location']
+                    throttle = get_throttle(cache.client.get_client())
+                    location_types = cache_location_hierarchy(cache)
+                    # the progress counts the entries, as the items count of the model
+                    rows_loaded = keys_written = LOCATION_HIERARCHY_ENTRIES
+                    for users_count, cache_data in iter_user_districts_cache_data(batch_size, location_types):
+                        set_preloaded_entries(cache, model, cache_data)
+                        if throttle:
+                            throttle.wait(len(cache_data), cache_data)
+                        index_cache_keys(cache, model, cache_data)
+                        rows_loaded += users_count
+                        keys_written += len(cache_data)
+                        if progress and progress(rows_loaded, keys_written) is False:
+                            return False
+                elif model == 'coverage':
+                    from cache_manager.coverage import (COVERAGE_BATCH_SIZE, build_coverage_cache_data,
+                                                        iter_coverage_chunks)
+                    cache = caches[model]
+                    throttle = get_throttle(cache.client.get_client())
+                    # the summaries depend on the claims and products, they are always rebuilt entirely
+                    for insurees, insuree_filter in iter_coverage_chunks(min(batch_size, COVERAGE_BATCH_SIZE)):
+                        cache_data = build_coverage_cache_data(insurees, insuree_filter)
+                        set_preloaded_entries(cache, model, cache_data)
+                        if throttle:
+                            throttle.wait(len(cache_data), cache_data)
+                        index_cache_keys(cache, model, cache_data)
+                        # the progress counts the entries, as the items count of the model
+                        rows_loaded += len(cache_data)
+                        keys_written += len(cache_data)
+                        if progress and progress(rows_loaded, keys_written) is False:
+                            return False
                 else:
                     cache = caches[model]
+                    throttle = get_throttle(cache.client.get_client())
                     # for obj in all_objects:
                     #     cache_data[get_cache_key_base(model, obj.id)] = obj
 
                     # cache.set_many(cache_data, timeout=CACHE_TIMEOUT)
-                    for chunk in chunked_queryset(all_objects, BATCH_SIZE):
+                    if watermark:
+                        for chunk in chunked_queryset(get_invalidated_rows(model_class, watermark), batch_size, "id"):
+                            evict_cache_keys(cache, model, [get_cache_key_base(model, row[0]) for row in chunk])
+                    for chunk in chunked_queryset(all_objects, batch_size, server_side_cursor=server_side_cursor):
                         cache_data = {
                             get_cache_key_base(model, obj.id): obj
                             for obj in chunk
                         }
-                        cache.set_many(cache_data, timeout=CACHE_TIMEOUT)
-            
+                        set_preloaded_entries(cache, model, cache_data)
+                        if throttle:
+                            throttle.wait(len(cache_data), cache_data)
+                        index_cache_keys(cache, model, cache_data)
+                        rows_loaded += len(chunk)
+                        keys_written += len(cache_data)
+                        max_id = max(chunk[-1].id, max_id) if max_id is not None else chunk[-1].id
+                        if progress and progress(rows_loaded, keys_written) is False:
+                            return False
+
+            save_preload_watermark(model_class, model, preload_started_at, max_id)
             return True
         except Exception as exc:
             raise ValidationError(_("Error_during_cache_preheating:") + str(exc))
 
 
+def cache_location_hierarchy(cache):
+    """
+    Writes the location graph and the location ids by type read by the location module, and returns the latter.
+    """
+    from cache_manager.location_user import build_location_hierarchy
+    graph, location_types = build_location_hierarchy()
+    cache.set_many({"location_graph": graph, "location_types": location_types}, timeout=None)
+    return location_types
+
+
 def get_cache_key_base(model, id):
     return f"{model}_{id}"
 
+
+_model_generations = {}
+
+
+def get_generation_key(model_class):
+    return f"cache_manager:generation:{model_class.__name__}"
+
+
+def get_generation_prefix(model_class, generation):
+    return f"oi:1:cs_{model_class.__name__}_g{generation}_"
+
+
+def get_model_generation(model_class):
+    """
+    Returns the generation of the model cache. The value is kept in process for generation_cache_ttl
+    seconds so that building keys does not cost a Redis round-trip each time.
+    """
+    generation, fetched_at = _model_generations.get(model_class.__name__, (None, 0))
+    if generation is None or time.monotonic() - fetched_at > CacheManagerConfig.generation_cache_ttl:
+        redis_client = caches['default'].client.get_client()
+        generation = int(redis_client.get(get_generation_key(model_class)) or 0)
+        _model_generations[model_class.__name__] = (generation, time.monotonic())
+    return generation
+
+
+def use_compact_encoding(cache):
+    """
+    Tells if preloaded payloads are written in the compact encoding: compact_encoding has to be enabled and the
+    cache configured with the CompactSerializer that decodes them on read.
+    """
+    if not CacheManagerConfig.compact_encoding:
+        return False
+    if isinstance(getattr(cache.client, "_serializer", None), CompactSerializer):
+        return True
+    logger.warning("compact_encoding requires cache_manager.serializers.CompactSerializer as SERIALIZER of the cache")
+    return False
+
+
+def get_projection_columns(model):
+    """
+    Returns the payload names, the queried columns and the key function of the projection of the model.
+    """
+    projection = get_preload_projection(model)
+    names = projection["fields"] + tuple(projection["related"])
+    columns = projection["fields"] + tuple(projection["related"].values())
+    return names, columns, projection["key"] or get_payload_cache_key
+
+
+def build_payload_cache_data(model, model_class, rows, compact=False):
+    """
+    Builds the {cache key: payload} of rows queried with the projection columns of the model.
+    """
+    names, _, key = get_projection_columns(model)
+    payloads = (dict(zip(names, row)) for row in rows)
+    return {
+        key(model_class, payload): encode_payload(model, payload) if compact else payload
+        for payload in payloads
+    }
+
+
+def get_preload_ttl(model):
+    """
+    Returns the TTL (in seconds) of the preloaded entries of the model, None when they do not expire.
+    """
+    return CacheManagerConfig.preload_ttls.get(model, CacheManagerConfig.preload_default_ttl) or None
+
+
+def set_preloaded_entries(cache, model, cache_data):
+    """
+    Writes preloaded entries with the TTL of the model. The entries of a batch are split into PRELOAD_TTL_GROUPS
+    groups, each written with its own timeout drawn within +/- preload_ttl_jitter of the TTL, so that the keys
+    written by a preheating do not all expire at once.
+    """
+    ttl = get_preload_ttl(model)
+    if not ttl or not cache_data:
+        cache.set_many(cache_data, timeout=None)
+        return
+    jitter = ttl * CacheManagerConfig.preload_ttl_jitter
+    items = list(cache_data.items())
+    group_size = -(-len(items) // PRELOAD_TTL_GROUPS)
+    for group, start in enumerate(range(0, len(items), group_size)):
+        # each group draws its timeout in its own slice of the jitter range
+        offset = 2 * jitter * (group + random.random()) / PRELOAD_TTL_GROUPS - jitter
+        cache.set_many(dict(items[start:start + group_size]), timeout=max(1, round(ttl + offset)))
+
+
+_early_refreshes = set()
+_early_refreshes_lock = threading.Lock()
+
+
+def refresh_if_expiring(cache, key):
+    """
+    Samples the reads of the preloaded model entries (early_refresh_sample_rate) and, when the sampled entry
+    expires within early_refresh_window seconds, rewrites it in a background thread instead of letting it expire.
+    Only the entries keyed by row id (the default projection key) of the default cache are refreshed.
+    """
+    if random.random() >= CacheManagerConfig.early_refresh_sample_rate:
+        return
+    match = UNPREFIXED_ROW_KEY_PATTERN.match(key)
+    model = get_cache_key_model(key, cache.key_prefix) if match else None
+    if not model or get_preload_projection(model)["key"] or not get_preload_ttl(model):
+        return
+    ttl = cache.ttl(key)
+    if not ttl or ttl > CacheManagerConfig.early_refresh_window:
+        return
+    with _early_refreshes_lock:
+        if key in _early_refreshes:
+            return
+        _early_refreshes.add(key)
+
+    def refresh():
+        try:
+            CacheService.sync_model_rows(model, [int(match.group(2))])
+        except Exception as exc:
+            logger.warning("Failed to refresh the cache entry %s: %s", key, exc)
+        finally:
+            connection.close()
+            with _early_refreshes_lock:
+                _early_refreshes.discard(key)
+
+    threading.Thread(target=refresh, name=f"cache_manager-refresh-{key}", daemon=True).start()
+
+
+def get_payload_cache_key(model_class, payload):
+    return get_model_cache_key(model_class, payload["id"])
+
+
+def get_model_cache_key(model_class, id):
+    """
+    Returns the cache key of a model row, including the model generation when versioning is enabled.
+    """
+    if CacheManagerConfig.model_cache_versioning:
+        return get_cache_key(model_class, f"g{get_model_generation(model_class)}_{id}")
+    return get_cache_key(model_class, id)
+
 BATCH_SIZE = 10000
+UNLINK_CHUNK_SIZE = 500
+SYNC_BATCH_SIZE = 1000
+MEMORY_USAGE_BATCH_SIZE = 1000
+MAX_PAYLOAD_SAMPLE_SIZE = 10000
+MODEL_KEY_PATTERN = re.compile(r'^oi:1:cs_([A-Za-z0-9]+)_(?:g(\d+)_)?')
+UNPREFIXED_MODEL_KEY_PATTERN = re.compile(r'^cs_([A-Za-z0-9]+)_')
+UNPREFIXED_ROW_KEY_PATTERN = re.compile(r'^cs_([A-Za-z0-9]+)_(?:g\d+_)?(\d+)$')
+PRELOAD_TTL_GROUPS = 8
 
 
-def chunked_queryset(qs: QuerySet, batch_size: int):
+def chunked_queryset(qs: QuerySet, batch_size: int, *fields, server_side_cursor=False):
     """
     Generator to yield queryset in chunks to avoid memory overload.
+    Rows are read in primary key order and each chunk seeks after the last primary key of the previous
+    one (keyset pagination) instead of using OFFSET, so the loading time grows linearly with the table.
+    When fields are given, chunks contain values_list tuples instead of model instances; the primary key
+    is added as first field if it is not requested.
+    With server_side_cursor, a single ordered query is streamed through a database cursor instead.
     """
-    start = 0
+    pk_name = qs.model._meta.pk.name
+    qs = qs.order_by(pk_name)
+    if fields:
+        if pk_name not in fields and "pk" not in fields:
+            fields = (pk_name, *fields)
+        pk_index = fields.index(pk_name) if pk_name in fields else fields.index("pk")
+        qs = qs.values_list(*fields)
+
+    if server_side_cursor:
+        rows = qs.iterator(chunk_size=batch_size)
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    last_pk = None
     while True:
-        chunk = list(qs[start:start+batch_size])
+        page = qs if last_pk is None else qs.filter(**{f"{pk_name}__gt": last_pk})
+        chunk = list(page[:batch_size])
         if not chunk:
             break
         yield chunk
-        start += batch_size
+        if len(chunk) < batch_size:
+            break
+        last_pk = chunk[-1][pk_index] if fields else chunk[-1].pk
+
+
+def unlink_keys_by_prefix(redis_client, prefix, batch_size=None, pause=0):
+    """
+    Removes all the keys matching the prefix, from all the primaries of a Redis Cluster in parallel.
+    Returns the number of removed keys and the elapsed time in seconds.
+    """
+    started = time.monotonic()
+    cluster = is_cluster_client(redis_client)
+    results = fan_out(redis_client, lambda node_client: unlink_node_keys_by_prefix(
+        node_client, prefix, batch_size, pause, per_key=cluster))
+    return {"removed_keys": sum(result["removed_keys"] for result in results), "elapsed": time.monotonic() - started}
+
+
+def unlink_node_keys_by_prefix(redis_client, prefix, batch_size=None, pause=0, per_key=False):
+    """
+    Removes all the keys matching the prefix. Scanned keys are accumulated in batches and sent
+    through a pipeline with non-blocking UNLINK commands, the memory is reclaimed by Redis in background.
+    An optional pause (in seconds) between batches lowers the pressure on Redis, as does the adaptive
+    throttle (cache_manager.throttle) when throttle_enabled is set.
+    With lua_scripts_enabled, the keys are scanned and removed inside Redis by slices of batch_size keys,
+    falling back to the pipelines if the scripts are not available. The keys of a cluster node are removed
+    one by one (per_key), as they belong to different hash slots, and without scripts.
+    Returns the number of removed keys and the elapsed time in seconds.
+    """
+    batch_size = batch_size or CacheManagerConfig.clear_batch_size
+    started = time.monotonic()
+    removed_keys = 0
+    throttle = get_throttle(redis_client)
+    if CacheManagerConfig.lua_scripts_enabled and not per_key:
+        try:
+            for removed in unlink_prefix_slices(redis_client, prefix, batch_size, pause, UNLINK_CHUNK_SIZE):
+                removed_keys += removed
+                if throttle:
+                    throttle.wait(removed)
+            return {"removed_keys": removed_keys, "elapsed": time.monotonic() - started}
+        except ResponseError as exc:
+            logger.warning("Failed to remove the keys of %s with a script, using pipelines: %s", prefix, exc)
+    batch = []
+    for key in redis_client.scan_iter(match=f'{prefix}*', count=CacheManagerConfig.scan_count):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            removed_keys += unlink_keys(redis_client, batch, per_key)
+            if throttle:
+                throttle.wait(len(batch))
+            batch = []
+            if pause:
+                time.sleep(pause)
+    if batch:
+        removed_keys += unlink_keys(redis_client, batch, per_key)
+    return {"removed_keys": removed_keys, "elapsed": time.monotonic() - started}
+
+
+def unlink_keys(redis_client, keys, per_key=False):
+    """
+    Sends one pipeline of UNLINK commands for the given keys and returns the number of removed keys.
+    With per_key, each key gets its own command, as required when they belong to different cluster hash slots.
+    """
+    if not keys:
+        return 0
+    chunk_size = 1 if per_key else UNLINK_CHUNK_SIZE
+    pipeline = redis_client.pipeline(transaction=False)
+    for start in range(0, len(keys), chunk_size):
+        pipeline.unlink(*keys[start:start + chunk_size])
+    return sum(pipeline.execute())
+
+
+def sweep_keys_by_prefix(redis_client, prefix, delay=0):
+    """
+    Removes the keys matching the prefix in a background thread, after delay seconds, with small batches and pauses.
+    """
+    def sweep():
+        if delay:
+            time.sleep(delay)
+        try:
+            result = unlink_keys_by_prefix(redis_client, prefix, batch_size=CacheManagerConfig.sweep_batch_size,
+                                           pause=CacheManagerConfig.sweep_pause)
+            logger.info("Swept %s keys of %s in %.3fs", result["removed_keys"], prefix, result["elapsed"])
+        except Exception as exc:
+            logger.error("Failed to sweep the keys of %s: %s", prefix, exc)
+
+    thread = threading.Thread(target=sweep, name=f"cache_manager-sweep-{prefix}", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_cluster_client(redis_client):
+    return RedisCluster is not None and isinstance(redis_client, RedisCluster)
+
+
+def get_node_clients(redis_client):
+    """
+    Returns the clients of the primaries of a Redis Cluster, or the client itself for a single server.
+    """
+    if is_cluster_client(redis_client):
+        return [redis_client.get_redis_connection(node) for node in redis_client.get_primaries()]
+    return [redis_client]
+
+
+def fan_out(redis_client, function):
+    """
+    Calls function(node client) for each primary of a Redis Cluster in parallel, or once for a single server,
+    and returns the list of the results.
+    """
+    node_clients = get_node_clients(redis_client)
+    if len(node_clients) == 1:
+        return [function(node_clients[0])]
+    with ThreadPoolExecutor(max_workers=len(node_clients), thread_name_prefix="cache_manager-node") as executor:
+        return list(executor.map(function, node_clients))
+
+
+def get_client_identity(redis_client):
+    """
+    Identifies the Redis server (and database) or cluster a client is connected to, so that caches sharing a
+    server are scanned only once.
+    """
+    if is_cluster_client(redis_client):
+        return ("cluster", *sorted(node.name for node in redis_client.get_primaries()))
+    kwargs = redis_client.connection_pool.connection_kwargs
+    return tuple(str(kwargs.get(name)) for name in ('host', 'port', 'path', 'db'))
+
+
+def iter_model_keys(redis_client, classes, prefixes):
+    """
+    Walks the keyspace of a Redis server once and yields (key, model) for each key belonging to a
+    supported model. classes maps model class names to (model, generation), generation being None
+    when the model cache is not versioned; prefixes lists (KEY_PREFIX, model) of module caches.
+    """
+    for key in redis_client.scan_iter(count=CacheManagerConfig.scan_count):
+        model = get_key_model(key.decode('utf-8', 'replace') if isinstance(key, bytes) else key, classes, prefixes)
+        if model is not None:
+            yield key, model
+
+
+def get_key_model(key, classes, prefixes):
+    match = MODEL_KEY_PATTERN.match(key)
+    if match and match.group(1) in classes:
+        model, generation = classes[match.group(1)]
+        if generation is None or match.group(2) == str(generation):
+            return model
+        return None
+    return next((model for prefix, model in prefixes if key.startswith(prefix)), None)
+
+
+def census_keyspace(redis_client, classes, prefixes, census, with_sizes=False):
+    """
+    Adds the count (and memory usage) of the keys of a Redis server to the bucket of their model in census,
+    the primaries of a Redis Cluster being walked in parallel.
+    """
+    if not is_cluster_client(redis_client):
+        return census_node_keyspace(redis_client, classes, prefixes, census, with_sizes)
+
+    def census_node(node_client):
+        node_census = {model: {"count": 0, "bytes": 0} for model in census}
+        return census_node_keyspace(node_client, classes, prefixes, node_census, with_sizes, scripts=False)
+
+    for node_census in fan_out(redis_client, census_node):
+        for model, node_counts in node_census.items():
+            census[model]["count"] += node_counts["count"]
+            census[model]["bytes"] += node_counts["bytes"]
+    return census
+
+
+def census_node_keyspace(redis_client, classes, prefixes, census, with_sizes=False, scripts=True):
+    """
+    Walks the keyspace of a Redis server once and adds the count (and memory usage) of each key to the
+    bucket of its model in census. Without sizes and with lua_scripts_enabled, the keys are counted inside Redis.
+    """
+    if not with_sizes and scripts and CacheManagerConfig.lua_scripts_enabled:
+        try:
+            for model, count in census_slices(redis_client, classes, prefixes).items():
+                census[model]["count"] += count
+            return census
+        except ResponseError as exc:
+            logger.warning("Failed to count the keys with a script, using SCAN: %s", exc)
+    sized_keys = []
+    for key, model in iter_model_keys(redis_client, classes, prefixes):
+        census[model]["count"] += 1
+        if with_sizes:
+            sized_keys.append((key, model))
+            if len(sized_keys) >= MEMORY_USAGE_BATCH_SIZE:
+                add_memory_usage(redis_client, sized_keys, census)
+                sized_keys = []
+    if sized_keys:
+        add_memory_usage(redis_client, sized_keys, census)
+    return census
+
+
+def add_memory_usage(redis_client, sized_keys, census):
+    pipeline = redis_client.pipeline(transaction=False)
+    for key, _ in sized_keys:
+        pipeline.memory_usage(key, samples=0)
+    for (_, model), usage in zip(sized_keys, pipeline.execute()):
+        census[model]["bytes"] += usage or 0
+
+
+def get_index_key(model, rebuilding=False):
+    """
+    Returns the Redis key of the SET indexing the cached keys of the model. The model name is a hash tag,
+    so that the index and the one being rebuilt are in the same cluster slot and can be renamed.
+    """
+    return f"cache_manager:index:{{{model}}}:rebuild" if rebuilding else f"cache_manager:index:{{{model}}}"
+
+
+def evict_cache_keys(cache, model, keys):
+    """
+    Deletes keys from a cache and from the key index of the model.
+    """
+    if not keys:
+        return
+    cache.delete_many(keys)
+    if CacheManagerConfig.key_index_enabled and not getattr(cache, "maintains_key_index", False):
+        remove_index_members(cache.client.get_client(), [(str(cache.make_key(key)), model) for key in keys])
+
+
+def index_cache_keys(cache, model, keys):
+    """
+    Adds keys written to a cache to the key index of the model, unless the cache backend maintains it itself.
+    """
+    if CacheManagerConfig.key_index_enabled and not getattr(cache, "maintains_key_index", False):
+        add_index_members(cache.client.get_client(), [(str(cache.make_key(key)), model) for key in keys])
+
+
+def is_indexed_model(model):
+    """
+    Tells if the keys of the model are kept in the key index. The entries of the models with a TTL expire without
+    any write removing them from the index, their keys are therefore not indexed.
+    """
+    return not get_preload_ttl(model)
+
+
+def add_index_members(redis_client, keyed_models, rebuilding=False):
+    """
+    Adds the (key, model) pairs to the key index of their model through one pipeline, except the keys of the
+    models with a TTL.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    for model, keys in group_keys_by_model(keyed_models).items():
+        if not is_indexed_model(model):
+            continue
+        pipeline.sadd(get_index_key(model, rebuilding), *keys)
+    pipeline.execute()
+
+
+def remove_index_members(redis_client, keyed_models):
+    """
+    Removes the (key, model) pairs from the key index of their model through one pipeline.
+    """
+    pipeline = redis_client.pipeline(transaction=False)
+    for model, keys in group_keys_by_model(keyed_models).items():
+        pipeline.srem(get_index_key(model), *keys)
+    pipeline.execute()
+
+
+def group_keys_by_model(keyed_models):
+    keys_by_model = {}
+    for key, model in keyed_models:
+        keys_by_model.setdefault(model, []).append(key)
+    return keys_by_model
+
+
+_key_prefix_models = {}
+
+
+def get_cache_key_model(key, key_prefix):
+    """
+    Returns the supported model the (unprefixed) key of a cache with the given KEY_PREFIX belongs to, or None.
+    The models of a prefix are derived again after a registration in cache_manager.registry.
+    """
+    version = get_registry_version()
+    if _key_prefix_models.get(key_prefix, (None,))[0] != version:
+        classes, prefixes = {}, []
+        for model in CacheService.openimis_models:
+            alias = CacheService.get_model_cache_alias(model)
+            if alias == 'default':
+                model_class, _ = CacheService.get_model_class(model)
+                classes[model_class.__name__] = (model, None)
+            elif settings.CACHES[alias].get('KEY_PREFIX', '') == key_prefix:
+                prefixes.append(('', model))
+        _key_prefix_models[key_prefix] = (version, classes, prefixes)
+    _, classes, prefixes = _key_prefix_models[key_prefix]
+    match = UNPREFIXED_MODEL_KEY_PATTERN.match(key)
+    if match and match.group(1) in classes:
+        return classes[match.group(1)][0]
+    return prefixes[0][1] if prefixes else None
+
+
+def estimate_items_count(model):
+    """
+    Returns the number of rows of the model table estimated by the database planner, or None when the
+    database does not provide an estimate or the entries of the model are not one per row.
+    """
+    try:
+        model_class, _ = CacheService.get_model_class(model)
+    except ValidationError:
+        return None
+    if get_cache_model_options(model)["count"]:
+        return None
+    table = model_class._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)",
+                           [connection.ops.quote_name(table)])
+        elif connection.vendor == 'microsoft':
+            cursor.execute("SELECT SUM(rows) FROM sys.partitions WHERE object_id = OBJECT_ID(%s) AND index_id IN (0, 1)",
+                           [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for tables that were never analyzed
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+_refreshing_counts = set()
+_refreshing_counts_lock = threading.Lock()
+
+
+def get_items_count_key(model):
+    return f"cache_manager:items_count:{model}"
+
+
+def get_cached_items_count(model):
+    """
+    Returns the exact count of the model kept in cache. The first call computes it, later calls return
+    the cached value and start a background refresh once it is older than item_count_ttl.
+    """
+    cached = caches['default'].get(get_items_count_key(model))
+    if cached is None:
+        cached = refresh_items_count(model)
+    elif (timezone.now() - cached["computed_at"]).total_seconds() > CacheManagerConfig.item_count_ttl:
+        with _refreshing_counts_lock:
+            refreshing = model in _refreshing_counts
+            _refreshing_counts.add(model)
+        if not refreshing:
+            threading.Thread(target=refresh_items_count, args=(model, True),
+                             name=f"cache_manager-count-{model}", daemon=True).start()
+    return {**cached, "strategy": "cached"}
+
+
+def refresh_items_count(model, in_background=False):
+    try:
+        cached = {"count": CacheService.items_count(model), "computed_at": timezone.now()}
+        caches['default'].set(get_items_count_key(model), cached, timeout=None)
+        return cached
+    except Exception as exc:
+        if not in_background:
+            raise
+        logger.error("Failed to refresh the items count of %s: %s", model, exc)
+    finally:
+        if in_background:
+            _refreshing_counts.discard(model)
+            connection.close()
+
+
+def get_watermark_key(model):
+    return f"cache_manager:watermark:{model}"
+
+
+def has_model_field(model_class, name):
+    return any(field.name == name for field in model_class._meta.get_fields())
+
+
+def get_preload_watermark(model_class, model):
+    """
+    Returns the watermark of the last preheating of the model: when it started and the highest id it loaded.
+    A watermark of a previous generation of a versioned model cache is ignored.
+    """
+    watermark = caches['default'].get(get_watermark_key(model))
+    if watermark and CacheManagerConfig.model_cache_versioning \
+            and watermark.get("generation") != get_model_generation(model_class):
+        return None
+    return watermark
+
+
+def save_preload_watermark(model_class, model, loaded_at, max_id):
+    watermark = {"loaded_at": loaded_at, "max_id": max_id}
+    if CacheManagerConfig.model_cache_versioning:
+        watermark["generation"] = get_model_generation(model_class)
+    caches['default'].set(get_watermark_key(model), watermark, timeout=None)
+
+
+def delete_preload_watermarks(*models):
+    caches['default'].delete_many([get_watermark_key(model) for model in models])
+
+
+def get_delta_filter(model_class, watermark):
+    """
+    Filters the rows created (id above the watermark) or changed (validity_from after the start of the
+    previous preheating) since the watermark. Models without validity_from only get their new rows.
+    """
+    delta = Q(pk__gt=watermark["max_id"]) if watermark["max_id"] is not None else Q()
+    if has_model_field(model_class, "validity_from"):
+        delta |= Q(validity_from__gte=watermark["loaded_at"])
+    return delta
+
+
+def get_invalidated_rows(model_class, watermark):
+    """
+    Returns the rows invalidated (validity_to set) since the start of the previous preheating. The history
+    copies (with a legacy_id) of edited rows are left out, their current version is reloaded instead.
+    """
+    invalidated = model_class.objects.filter(validity_to__gte=watermark["loaded_at"])
+    if has_model_field(model_class, "legacy_id"):
+        invalidated = invalidated.filter(legacy_id__isnull=True)
+    return invalidated
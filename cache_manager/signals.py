@@ -0,0 +1,119 @@
+import logging
+import threading
+from functools import partial
+
+from django.core.exceptions import ValidationError
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.services import CacheService, get_projection_columns
+
+logger = logging.getLogger(__name__)
+
+REFRESH = "refresh"
+INVALIDATE = "invalidate"
+
+_synced_models = {}
+_pending = threading.local()
+
+
+def bind_cache_signals():
+    """
+    Connects the post_save/post_delete handlers of the models enabled in row_sync_models, with "refresh" to
+    rewrite the cache entry of a changed row or "invalidate" to evict it. The unknown models and those of modules
+    that are not installed are skipped.
+    """
+    request_finished.connect(flush_pending_changes, dispatch_uid="cache_manager_flush_pending_changes")
+    for model, mode in CacheManagerConfig.row_sync_models.items():
+        if mode not in (REFRESH, INVALIDATE):
+            continue
+        try:
+            model_class, is_model = CacheService.get_model_class(model)
+        except ValidationError:
+            logger.warning("Row synchronization is skipped for %s, unknown or of a module not installed", model)
+            continue
+        if not is_model:
+            logger.warning("Row synchronization is only supported for model caches, not for %s", model)
+            continue
+        _synced_models[model_class] = (model, mode)
+        post_save.connect(on_row_saved, sender=model_class, weak=False,
+                          dispatch_uid=f"cache_manager_post_save_{model}")
+        post_delete.connect(on_row_deleted, sender=model_class, weak=False,
+                            dispatch_uid=f"cache_manager_post_delete_{model}")
+
+
+def on_row_saved(sender, instance, **kwargs):
+    model, mode = _synced_models[sender]
+    if mode == REFRESH and getattr(instance, "validity_to", None) is None:
+        add_pending_change(model, refreshed_id=instance.pk)
+    else:
+        add_pending_change(model, evicted_key=get_instance_cache_key(model, sender, instance))
+
+
+def on_row_deleted(sender, instance, **kwargs):
+    model, _ = _synced_models[sender]
+    add_pending_change(model, evicted_key=get_instance_cache_key(model, sender, instance))
+
+
+def get_instance_cache_key(model, model_class, instance):
+    names, _, key = get_projection_columns(model)
+    return key(model_class, {name: getattr(instance, name, None) for name in names})
+
+
+def add_pending_change(model, refreshed_id=None, evicted_key=None):
+    """
+    Buffers a row change. Changes made outside of a transaction are written at once. In a transaction, each change
+    registers its own on_commit callback, so that the changes of a rolled back transaction or savepoint are
+    discarded with their callbacks; the callbacks add their change to the batch of the thread, and the last one
+    registered writes the whole batch.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        flush_changes({model: ({refreshed_id} - {None}, {evicted_key} - {None})})
+        return
+    batch = getattr(_pending, "batch", None)
+    if batch is None:
+        batch = _pending.batch = PendingBatch()
+    batch.registered += 1
+    transaction.on_commit(partial(batch.commit, batch.registered, model, refreshed_id, evicted_key))
+
+
+class PendingBatch:
+    """
+    Changes of the committed transactions of a thread not written yet.
+    """
+
+    def __init__(self):
+        self.registered = 0
+        self.changes = {}
+
+    def commit(self, index, model, refreshed_id, evicted_key):
+        refreshed_ids, evicted_keys = self.changes.setdefault(model, (set(), set()))
+        if refreshed_id is not None:
+            refreshed_ids.add(refreshed_id)
+        if evicted_key is not None:
+            evicted_keys.add(evicted_key)
+        # when the last changes were rolled back with a savepoint, the batch is written by the next transaction
+        # or at the end of the request
+        if index == self.registered:
+            self.flush()
+
+    def flush(self):
+        if getattr(_pending, "batch", None) is self:
+            _pending.batch = None
+        flush_changes(self.changes)
+
+
+def flush_pending_changes(**kwargs):
+    batch = getattr(_pending, "batch", None)
+    if batch is not None and batch.changes:
+        batch.flush()
+
+
+def flush_changes(changes):
+    for model, (refreshed_ids, evicted_keys) in changes.items():
+        try:
+            CacheService.sync_model_rows(model, refreshed_ids, evicted_keys)
+        except Exception as exc:
+            logger.error("Failed to synchronize the cache of %s: %s", model, exc)
@@ -0,0 +1,84 @@
+import bisect
+import threading
+import time
+from collections import Counter
+
+from cache_manager.apps import CacheManagerConfig
+
+# upper bounds (in milliseconds) of the buckets of the get latency histograms, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+HITS = "hits"
+MISSES = "misses"
+SETS = "sets"
+DELETES = "deletes"
+
+
+def get_stats_key(model):
+    return f"cache_manager:stats:{model}"
+
+
+class CacheStatsCollector:
+    """
+    Counts the hits, misses, sets and deletes of each model and its get latency histogram in process.
+    The counters are added to the Redis hash of each model at most every stats_flush_interval seconds,
+    so that recording an operation costs no round-trip.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.last_flush = time.monotonic()
+
+    def record(self, model, event, count=1, latency=None):
+        with self.lock:
+            counters = self.counters.setdefault(model, Counter())
+            counters[event] += count
+            if latency is not None:
+                counters[f"latency_{bisect.bisect_left(LATENCY_BUCKETS_MS, latency * 1000)}"] += 1
+
+    def flush_if_due(self, redis_client):
+        if time.monotonic() - self.last_flush < CacheManagerConfig.stats_flush_interval:
+            return
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            self.last_flush = time.monotonic()
+        if not counters:
+            return
+        pipeline = redis_client.pipeline(transaction=False)
+        for model, model_counters in counters.items():
+            for field, count in model_counters.items():
+                pipeline.hincrby(get_stats_key(model), field, count)
+        pipeline.execute()
+
+
+def summarize_stats(raw_stats):
+    """
+    Computes the hit ratio, the miss rate and the p50/p99 get latencies (in milliseconds, upper bound of
+    their histogram bucket, the last bound for slower gets) from the Redis hash of a model.
+    """
+    stats = {(field.decode() if isinstance(field, bytes) else field): int(value) for field, value in raw_stats.items()}
+    gets = stats.get(HITS, 0) + stats.get(MISSES, 0)
+    histogram = [stats.get(f"latency_{index}", 0) for index in range(len(LATENCY_BUCKETS_MS) + 1)]
+    return {
+        "hits": stats.get(HITS, 0),
+        "misses": stats.get(MISSES, 0),
+        "sets": stats.get(SETS, 0),
+        "deletes": stats.get(DELETES, 0),
+        "hit_ratio": stats.get(HITS, 0) / gets if gets else None,
+        "miss_rate": stats.get(MISSES, 0) / gets if gets else None,
+        "get_latency_p50": get_percentile(histogram, 0.5),
+        "get_latency_p99": get_percentile(histogram, 0.99),
+    }
+
+
+def get_percentile(histogram, percentile):
+    total = sum(histogram)
+    if not total:
+        return None
+    cumulated = 0
+    for index, count in enumerate(histogram):
+        cumulated += count
+        if cumulated >= percentile * total:
+            return LATENCY_BUCKETS_MS[min(index, len(LATENCY_BUCKETS_MS) - 1)]
+    return None
@@ -0,0 +1,154 @@
+"""
+Benchmarks of the cache manager hot paths against a real Redis (or fakeredis) and a database fixture.
+
+They are not collected with the tests, run them explicitly:
+
+    CACHE_MANAGER_BENCHMARK=1 python manage.py test cache_manager.tests.benchmarks
+
+Environment variables:
+* CACHE_MANAGER_BENCHMARK_SIZES: the numbers of keys and rows seeded (default: 10000,100000,1000000)
+* CACHE_MANAGER_BENCHMARK_REDIS: the URL of the Redis used, e.g. redis://localhost:6379/15, or "fakeredis"
+  (default). The database is flushed.
+* CACHE_MANAGER_BENCHMARK_REPEAT: the number of timed runs of each operation (default: 3)
+* CACHE_MANAGER_BENCHMARK_OUTPUT: a file the JSON report is written to, it is printed otherwise
+"""
+import json
+import os
+import pickle
+import statistics
+import time
+import tracemalloc
+import unittest
+from unittest.mock import MagicMock
+
+from django.core.cache import caches
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from cache_manager import services
+from cache_manager.schema import Query
+from cache_manager.services import CacheService, get_cache_key_base
+from core.test_helpers import create_test_interactive_user
+from medical.models import Diagnosis
+
+BENCHMARK_ENABLED = bool(os.getenv("CACHE_MANAGER_BENCHMARK"))
+SIZES = [int(size) for size in os.getenv("CACHE_MANAGER_BENCHMARK_SIZES", "10000,100000,1000000").split(",")]
+REDIS_URL = os.getenv("CACHE_MANAGER_BENCHMARK_REDIS", "fakeredis")
+REPEAT = int(os.getenv("CACHE_MANAGER_BENCHMARK_REPEAT", "3"))
+SEED_BATCH_SIZE = 10000
+
+
+def get_benchmark_caches():
+    options = {}
+    location = REDIS_URL
+    if REDIS_URL == "fakeredis":
+        import fakeredis
+        options = {"CONNECTION_POOL_KWARGS": {"connection_class": fakeredis.FakeConnection}}
+        location = "redis://localhost:6379/15"
+
+    def cache(key_prefix):
+        return {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": location,
+            "KEY_PREFIX": key_prefix,
+            "OPTIONS": options,
+        }
+    return {"default": cache("oi"), "location": cache("location"), "coverage": cache("coverage")}
+
+
+def measure(operation, items, setup=None, repeat=REPEAT):
+    """
+    Times repeat runs of operation (setup, untimed, is called before each run), then measures the peak of the
+    memory allocated by one more run. Returns the latencies, the throughput in items per second and the peak.
+    """
+    latencies = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - started)
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    median = statistics.median(latencies)
+    return {
+        "items": items,
+        "latency_median": median,
+        "latency_min": min(latencies),
+        "latency_max": max(latencies),
+        "throughput": items / median if median else None,
+        "peak_memory_bytes": peak,
+    }
+
+
+@unittest.skipUnless(BENCHMARK_ENABLED, "set CACHE_MANAGER_BENCHMARK=1 to run the benchmarks")
+@override_settings(CACHES=get_benchmark_caches() if BENCHMARK_ENABLED else {})
+class CacheManagerBenchmark(TransactionTestCase):
+    report = {}
+
+    def setUp(self):
+        services._key_prefix_models.clear()
+        services._model_generations.clear()
+        self.redis_client = caches['default'].client.get_client()
+        self.redis_client.flushdb()
+        self.user = create_test_interactive_user(username="cacheBenchmarkAdmin")
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        report = json.dumps({"redis": REDIS_URL, "repeat": REPEAT, "results": cls.report}, indent=2)
+        output = os.getenv("CACHE_MANAGER_BENCHMARK_OUTPUT")
+        if output:
+            with open(output, "w") as report_file:
+                report_file.write(report)
+        else:
+            print(report)
+
+    def seed_diagnoses(self, size):
+        Diagnosis.objects.all().delete()
+        now = timezone.now()
+        for start in range(0, size, SEED_BATCH_SIZE):
+            Diagnosis.objects.bulk_create(
+                Diagnosis(code=f"B{index:05X}", name=f"Benchmark {index}", audit_user_id=-1, validity_from=now)
+                for index in range(start, min(start + SEED_BATCH_SIZE, size))
+            )
+
+    def seed_keys(self, prefix, size):
+        payload = pickle.dumps({"id": 0, "code": "B00000", "name": "Benchmark"}, pickle.HIGHEST_PROTOCOL)
+        for start in range(0, size, SEED_BATCH_SIZE):
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for index in range(start, min(start + SEED_BATCH_SIZE, size)):
+                pipeline.set(f"{prefix}{index}", payload)
+            pipeline.execute()
+
+    def test_benchmark(self):
+        for size in SIZES:
+            self.seed_diagnoses(size)
+            results = self.report[str(size)] = {}
+
+            results["preload_model_cache"] = measure(
+                lambda: CacheService.preload_model_cache("diagnosis", self.user), size,
+                setup=self.redis_client.flushdb)
+
+            results["clear_all_model_cache"] = measure(
+                lambda: CacheService.clear_all_model_cache("diagnosis"), size,
+                setup=lambda: self.seed_keys(CacheService.get_prefixed_model("diagnosis"), size))
+
+            results["clear_module_cache"] = measure(
+                lambda: CacheService.clear_module_cache("location"), size,
+                setup=lambda: self.seed_keys(f"location:1:{get_cache_key_base('location', '')}", size))
+
+            self.redis_client.flushdb()
+            self.seed_keys(CacheService.get_prefixed_model("diagnosis"), size)
+            info = MagicMock()
+            info.context.user = self.user
+            results["resolve_cache_info"] = measure(
+                lambda: Query().resolve_cache_info(info, first=len(CacheService.openimis_models)), size)
+
+            self.assertEqual(CacheService.keyspace_census(["diagnosis"])["diagnosis"]["count"], size)
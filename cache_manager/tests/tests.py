@@ -1,18 +1,47 @@
+import datetime
+import decimal
 import json
+import uuid
 from dataclasses import dataclass
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY, call
 from core.models.openimis_graphql_test_case import openIMISGraphQLTestCase
-from cache_manager.schema import CacheService
-from cache_manager.services import get_cache_key_base
+from cache_manager.schema import CacheService, PreheatCacheMutation, Query
+from cache_manager.apps import CacheManagerConfig
+from cache_manager.jobs import PreheatJobService, get_job_key, is_serving_process, run_startup_warmup
+from cache_manager.coverage import (build_coverage_cache_data, get_claims_filter, get_coverage_cache_key,
+                                    iter_coverage_chunks)
+from cache_manager.location_user import build_user_districts_cache_data
+from cache_manager.reconcile import reconcile_key_batch
+from cache_manager.local_cache import LocalCache, MISSING
+from cache_manager.registry import get_preload_projection, register_cache_model, register_preload_projection
+from cache_manager.signals import bind_cache_signals
+from cache_manager.serializers import (CompactSerializer, FLAG_ZLIB, HEADER, MARKER, UndecodableEntryError,
+                                       decode_payload, encode_payload)
+from cache_manager.backends import CacheManagerRedisCache
+from cache_manager.stats import HITS, MISSES, summarize_stats
+from cache_manager.throttle import Throttle
+from cache_manager.services import (get_cache_key_base, unlink_keys_by_prefix, unlink_keys, census_keyspace,
+                                    set_preloaded_entries, get_cache_key_model, add_index_members,
+                                    get_index_key, chunked_queryset, estimate_items_count,
+                                    get_items_count_key, refresh_items_count)
 from insuree.test_helpers import create_test_insuree
+from location.apps import LocationConfig
 from location.models import Location
-from core.models import User
+from medical.models import Diagnosis, Service
+from medical.test_helpers import create_test_diagnosis
+from core.models import InteractiveUser, User
 from core.test_helpers import create_test_interactive_user
 from graphql_jwt.shortcuts import get_token
 from location.test_helpers import create_test_village
 import os
 from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 from core.utils import get_cache_key
 
 @dataclass
@@ -185,24 +214,24 @@ class CacheManagerTestCase(openIMISGraphQLTestCase):
     def test_preheat_cache_mutation(self):
         mutation = """
         mutation {
-            preheatCache(input: { model: "location" }) {
+            preheatCache(input: { model: "location", clientMutationId: "preheat-location" }) {
                 clientMutationId
             }
         }
         """
-        response = self.query(
-            mutation,
-            headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
-        )
+        with patch.object(CacheManagerConfig, 'preheat_in_background', True), \
+                patch('cache_manager.jobs.caches', {"default": self.cache}), \
+                patch('cache_manager.schema.PreheatJobService.start_created') as mock_start:
+            response = self.query(
+                mutation,
+                headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+            )
         self.assertResponseNoErrors(response)
-
-        cache_key = get_cache_key(Location, self.location.id)
-        if self.cache.get(cache_key) is None:
-            self.cache.set(cache_key, self.location)
-
-        cached_data = self.cache.get(cache_key)
-        self.assertIsNotNone(cached_data)
-        self.assertEqual(cached_data.id, self.location.id)
+        mock_start.assert_called_once()
+        job = mock_start.call_args[0][0]
+        self.assertEqual(job["job_id"], "preheat-location")
+        self.assertEqual([model["model"] for model in job["models"]], ["location"])
+        self.assertEqual(self.cache.get(get_job_key("preheat-location"))["status"], PreheatJobService.STATUS_QUEUED)
 
     def test_clear_module_cache(self):
         cache = self.mock_caches['location']
@@ -244,3 +273,596 @@ class CacheManagerTestCase(openIMISGraphQLTestCase):
     def test_get_prefixed_model(self):
         prefix = CacheService.get_prefixed_model('location')
         self.assertEqual(prefix, 'oi:1:cs_Location_')
+
+    def test_get_prefixed_model_with_versioning(self):
+        with patch.object(CacheManagerConfig, 'model_cache_versioning', True), \
+                patch('cache_manager.services.get_model_generation', return_value=3):
+            prefix = CacheService.get_prefixed_model('location')
+        self.assertEqual(prefix, 'oi:1:cs_Location_g3_')
+
+    def test_unlink_keys_by_prefix(self):
+        redis_client = MagicMock()
+        redis_client.scan_iter.return_value = iter([b'oi:1:cs_Location_1', b'oi:1:cs_Location_2', b'oi:1:cs_Location_3'])
+        pipeline = redis_client.pipeline.return_value
+        pipeline.execute.side_effect = [[2], [1]]
+
+        with patch.object(CacheManagerConfig, 'lua_scripts_enabled', False):
+            result = unlink_keys_by_prefix(redis_client, 'oi:1:cs_Location_', batch_size=2)
+
+        self.assertEqual(result["removed_keys"], 3)
+        pipeline.unlink.assert_any_call(b'oi:1:cs_Location_1', b'oi:1:cs_Location_2')
+        pipeline.unlink.assert_any_call(b'oi:1:cs_Location_3')
+        redis_client.delete.assert_not_called()
+
+    def test_unlink_keys_per_key(self):
+        redis_client = MagicMock()
+        pipeline = redis_client.pipeline.return_value
+        pipeline.execute.return_value = [1, 1]
+
+        self.assertEqual(unlink_keys(redis_client, [b'oi:1:cs_Item_1', b'oi:1:cs_Item_2'], per_key=True), 2)
+        pipeline.unlink.assert_any_call(b'oi:1:cs_Item_1')
+        pipeline.unlink.assert_any_call(b'oi:1:cs_Item_2')
+
+    def test_unlink_keys_by_prefix_with_script(self):
+        redis_client = MagicMock()
+        script = redis_client.register_script.return_value
+        script.side_effect = [[b'42', 2], [b'0', 1]]
+
+        with patch.object(CacheManagerConfig, 'lua_scripts_enabled', True):
+            result = unlink_keys_by_prefix(redis_client, 'oi:1:cs_Location_', batch_size=2)
+
+        self.assertEqual(result["removed_keys"], 3)
+        self.assertEqual(script.call_args_list[1].kwargs["args"][:2], [b'42', 'oi:1:cs_Location_*'])
+        redis_client.scan_iter.assert_not_called()
+
+    def test_census_keyspace(self):
+        redis_client = MagicMock()
+        redis_client.scan_iter.return_value = iter([
+            b'oi:1:cs_Location_1', b'oi:1:cs_Location_2', b'oi:1:cs_Insuree_1', b'location:1:user_districts_1'
+        ])
+        census = {model: {"count": 0, "bytes": 0} for model in ('location', 'location_user')}
+
+        with patch.object(CacheManagerConfig, 'lua_scripts_enabled', False):
+            census_keyspace(redis_client, {'Location': ('location', None)}, [('location', 'location_user')], census)
+
+        redis_client.scan_iter.assert_called_once()
+        self.assertEqual(census['location']["count"], 2)
+        self.assertEqual(census['location_user']["count"], 1)
+
+    def test_recount_cache_mutation(self):
+        with patch.object(CacheService, 'rebuild_key_index', return_value={'insuree': 1}) as mock_rebuild:
+            mutation = """
+            mutation {
+                recountCache(input: { models: ["insuree"] }) {
+                    clientMutationId
+                }
+            }
+            """
+            response = self.query(
+                mutation,
+                headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+            )
+            mock_rebuild.assert_called_once_with(['insuree'])
+        self.assertResponseNoErrors(response)
+
+    def test_preheat_cache_mutation_starts_job(self):
+        with patch.object(CacheManagerConfig, 'preheat_in_background', True), \
+                patch('cache_manager.schema.PreheatJobService.create', return_value={"job_id": "job-1"}) as mock_create, \
+                patch('cache_manager.schema.PreheatJobService.start_created') as mock_start:
+            mutation = """
+            mutation {
+                preheatCache(input: { models: ["location", "item"], clientMutationId: "job-1" }) {
+                    clientMutationId
+                }
+            }
+            """
+            response = self.query(
+                mutation,
+                headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"},
+            )
+        self.assertResponseNoErrors(response)
+        mock_create.assert_called_once_with(['item', 'location'], job_id="job-1", incremental=False)
+        mock_start.assert_called_once()
+
+    def test_preheat_job_requires_client_mutation_id_and_authentication(self):
+        with patch.object(CacheManagerConfig, 'preheat_in_background', True), \
+                patch('cache_manager.schema.PreheatJobService.start_created') as mock_start:
+            errors = PreheatCacheMutation.async_mutate(self.admin_user, models=["location"])
+        self.assertIn("Client_mutation_id_required_for_preheat_job", errors[0]["detail"])
+        mock_start.assert_not_called()
+        query = """
+        {
+            preheatJob(jobId: "job-1") {
+                status
+            }
+        }
+        """
+        with patch('cache_manager.schema.PreheatJobService.get') as mock_get:
+            response = self.query(query)
+        self.assertResponseHasErrors(response)
+        mock_get.assert_not_called()
+
+    def test_preheat_job_models_priority(self):
+        with patch.object(CacheManagerConfig, 'preheat_priority', ['service', 'item']):
+            models = PreheatJobService.get_models(['location', 'Item', 'service', 'item'])
+        self.assertEqual(models, ['service', 'item', 'location'])
+        self.assertEqual(set(PreheatJobService.get_models(['all'])), CacheService.openimis_models)
+
+    def test_get_preload_projection(self):
+        projection = get_preload_projection('health_facility')
+        self.assertEqual(projection["fields"][0], "id")
+        self.assertEqual(projection["related"], {"location_code": "location__code"})
+        self.assertEqual(get_preload_projection('extract')["fields"], ("id",))
+
+    def test_summarize_stats(self):
+        stats = summarize_stats({b'hits': b'3', b'misses': b'1', b'latency_2': b'3', b'latency_5': b'1'})
+        self.assertEqual(stats["hit_ratio"], 0.75)
+        self.assertEqual(stats["miss_rate"], 0.25)
+        self.assertEqual(stats["get_latency_p50"], 1)
+        self.assertEqual(stats["get_latency_p99"], 10)
+
+    def test_set_preloaded_entries_jitters_ttl(self):
+        cache = MagicMock()
+        cache_data = {f"cs_Item_{id}": {"id": id} for id in range(100)}
+        with patch.object(CacheManagerConfig, 'preload_ttls', {'item': 1000}), \
+                patch.object(CacheManagerConfig, 'preload_ttl_jitter', 0.1):
+            set_preloaded_entries(cache, 'item', cache_data)
+        timeouts = [call.kwargs["timeout"] for call in cache.set_many.call_args_list]
+        written = {key for call in cache.set_many.call_args_list for key in call.args[0]}
+        self.assertEqual(written, set(cache_data))
+        self.assertGreater(len(set(timeouts)), 1)
+        self.assertTrue(all(900 <= timeout <= 1100 for timeout in timeouts))
+
+    def test_clear_cache_command(self):
+        with patch.object(CacheService, 'clear_cache', return_value={"removed_keys": 3, "elapsed": 0.1}) as mock_clear:
+            call_command('clear_cache', 'Item', 'location_user')
+        self.assertEqual([call.args[0] for call in mock_clear.call_args_list], ['item', 'location_user'])
+        with self.assertRaises(CommandError):
+            call_command('preheat_cache', 'not_a_model')
+
+    def test_startup_warmup_skipped_without_lock(self):
+        with patch('cache_manager.jobs.caches') as mock_caches, patch('cache_manager.jobs.connection'), \
+                patch.object(PreheatJobService, 'create') as mock_create:
+            mock_caches['default'].add.return_value = False
+            self.assertIsNone(run_startup_warmup())
+        mock_create.assert_not_called()
+
+    def test_local_cache_lru(self):
+        local_cache = LocalCache()
+        with patch.object(CacheManagerConfig, 'local_cache_max_entries', 2):
+            local_cache.set('oi:1:cs_Item_1', 'item', {"id": 1})
+            local_cache.set('oi:1:cs_Item_2', 'item', {"id": 2})
+            local_cache.get('oi:1:cs_Item_1')
+            local_cache.set('oi:1:cs_Service_1', 'service', {"id": 1})
+        self.assertIs(local_cache.get('oi:1:cs_Item_2'), MISSING)
+        self.assertEqual(local_cache.get('oi:1:cs_Item_1'), {"id": 1})
+        local_cache.apply({"models": ["item"]})
+        self.assertEqual(list(local_cache.entries), ['oi:1:cs_Service_1'])
+
+    def test_throttle_backs_off_when_redis_is_busy(self):
+        redis_client = MagicMock()
+        redis_client.info.return_value = {"instantaneous_ops_per_sec": 90000}
+        throttle = Throttle(redis_client)
+        with patch.object(CacheManagerConfig, 'throttle_max_server_ops', 50000), \
+                patch.object(CacheManagerConfig, 'throttle_check_interval', 0), \
+                patch.object(CacheManagerConfig, 'throttle_backoff_pause', 0), \
+                patch('cache_manager.throttle.time.sleep'):
+            throttle.wait(100)
+            throttle.wait(100)
+            self.assertEqual(throttle.backoff, 4)
+            redis_client.info.return_value = {"instantaneous_ops_per_sec": 1000}
+            throttle.wait(100)
+        self.assertEqual(throttle.backoff, 2)
+
+    def test_build_coverage_cache_data_groups_by_family(self):
+        summary = {"policy__product_id": 1, "total_visits": 2, "total_visits_left": 3}
+        with patch('cache_manager.coverage.get_coverage_summaries', return_value={1: summary}):
+            cache_data = build_coverage_cache_data([(1, 10), (2, 10), (3, None)], None)
+        self.assertEqual(cache_data, {
+            "eligibility_10": {"1": summary, "2": None},
+            "eligibility_3": {"3": None},
+        })
+
+    def test_build_user_districts_cache_data_gives_all_districts_to_admins(self):
+        with patch('cache_manager.location_user.get_admin_user_ids', return_value={2}), \
+                patch('cache_manager.location_user.UserDistrict') as mock_user_district:
+            mock_user_district.objects.filter.return_value.order_by.return_value.values_list.return_value \
+                .iterator.return_value = [(1, 11, 101), (1, 12, 102), (2, 13, 101)]
+            cache_data = build_user_districts_cache_data({1, 2, 3}, None, [[0, 101], [0, 102], [0, 103]])
+        self.assertEqual(cache_data, {
+            "user_districts_1": [[11, 101], [12, 102]],
+            "user_districts_2": [[0, 101], [0, 102], [0, 103]],
+            "user_districts_3": [],
+        })
+
+    def test_reconcile_key_batch_reports_orphaned_entries(self):
+        report = {"scanned_keys": 0, "orphaned": 0, "repaired": 0, "samples": {"orphaned": []}}
+        model_class = MagicMock()
+        model_class.objects.filter.return_value.values_list.return_value = [1, 3]
+        with patch('cache_manager.reconcile.evict_cache_keys') as mock_evict, \
+                patch('cache_manager.reconcile.get_model_cache_key', side_effect=lambda _, row_id: f"cs_Item_{row_id}"):
+            reconcile_key_batch(MagicMock(), 'item', model_class, [1, 2, 3, 4], report, True, None)
+        self.assertEqual(report["orphaned"], 2)
+        self.assertEqual(report["samples"]["orphaned"], [2, 4])
+        mock_evict.assert_called_once_with(ANY, 'item', ["cs_Item_2", "cs_Item_4"])
+
+    def test_registry_leaves_out_models_of_uninstalled_modules(self):
+        with patch.dict('cache_manager.registry._cache_models'):
+            register_cache_model("cheque", "not_installed.Cheque")
+            self.assertNotIn("cheque", CacheService.openimis_models)
+            self.assertIn("location", CacheService.openimis_models)
+        self.assertEqual(CacheService.get_model_class("location"), (Location, True))
+
+    def test_coverage_claims_filter_is_restricted_to_the_policy_period(self):
+        claims_filter = get_claims_filter(Service.CATEGORY_VISIT)
+        conditions = [child for child in claims_filter.flatten() if isinstance(child, tuple)]
+        self.assertIn(("insuree__claim__date_from__gte", F("effective_date")), conditions)
+        self.assertIn(("insuree__claim__date_from__lte", F("expiry_date")), conditions)
+
+    def test_startup_warmup_only_in_serving_processes(self):
+        self.assertTrue(is_serving_process(["/usr/local/bin/gunicorn", "openIMIS.wsgi"], {}))
+        self.assertFalse(is_serving_process(["manage.py", "migrate"], {}))
+        self.assertFalse(is_serving_process(["manage.py", "runserver"], {}))
+        self.assertTrue(is_serving_process(["manage.py", "runserver"], {"RUN_MAIN": "true"}))
+        self.assertTrue(is_serving_process(["manage.py", "migrate"], {"CACHE_MANAGER_STARTUP_WARMUP": "1"}))
+
+    def test_startup_warmup_releases_its_lock(self):
+        job = {"job_id": "1", "models": []}
+        thread = MagicMock()
+        thread.is_alive.return_value = False
+        with patch('cache_manager.jobs.caches') as mock_caches, patch('cache_manager.jobs.connection'), \
+                patch('cache_manager.jobs.release_lock') as mock_release, \
+                patch.object(PreheatJobService, 'create', return_value=job), \
+                patch.object(PreheatJobService, 'start_created', return_value=thread):
+            mock_caches['default'].add.return_value = True
+            self.assertIs(run_startup_warmup(), job)
+        lock_owner = mock_caches['default'].add.call_args[0][1]
+        mock_caches['default'].client.encode.assert_called_once_with(lock_owner)
+        mock_release.assert_called_once()
+
+    def test_compact_payload_round_trip(self):
+        payload = {
+            "id": 1,
+            "amount": decimal.Decimal("12.50"),
+            "day": datetime.date(2024, 2, 29),
+            "moment": datetime.datetime(2024, 2, 29, 13, 45, 10, 123456),
+            "uuid": uuid.uuid4(),
+            "name": "Paracetamol",
+        }
+        with patch.dict('cache_manager.registry._preload_projections'), \
+                patch.object(CacheManagerConfig, 'compact_compress_threshold', 128):
+            register_preload_projection("compact_test", tuple(payload))
+            short = encode_payload("compact_test", payload)
+            compressed = encode_payload("compact_test", {**payload, "name": "Paracetamol " * 20})
+            self.assertFalse(short[len(MARKER)] & FLAG_ZLIB)
+            self.assertTrue(compressed[len(MARKER)] & FLAG_ZLIB)
+            self.assertEqual(decode_payload(short), payload)
+            self.assertEqual(decode_payload(compressed), {**payload, "name": "Paracetamol " * 20})
+
+    def test_compact_entry_of_unknown_layout_is_a_miss(self):
+        entry = MARKER + HEADER.pack(0, 12345) + b"\x90"
+        with self.assertRaises(UndecodableEntryError):
+            CompactSerializer({}).loads(entry)
+        backend = self.get_backend()
+
+        def get(key, default=None, **kwargs):
+            if key == "cs_Diagnosis_2":
+                raise UndecodableEntryError()
+            return "first" if key == "cs_Diagnosis_1" else default
+
+        backend.client.get.side_effect = get
+        backend.client.get_many.side_effect = UndecodableEntryError()
+        with patch.object(CacheManagerConfig, 'stats_enabled', True), \
+                patch('cache_manager.backends.caches'), \
+                patch('cache_manager.backends._stats_collector') as mock_collector:
+            self.assertEqual(backend.get("cs_Diagnosis_2", "default"), "default")
+            self.assertEqual(backend.get_many(["cs_Diagnosis_1", "cs_Diagnosis_2"]), {"cs_Diagnosis_1": "first"})
+        self.assertEqual([call.args[:3] for call in mock_collector.record.call_args_list], [
+            ("diagnosis", MISSES, 1),
+            ("diagnosis", HITS, 1),
+            ("diagnosis", MISSES, 1),
+        ])
+
+    def test_bump_model_generation_sweeps_the_previous_generation(self):
+        with patch('cache_manager.services.caches') as mock_caches, \
+                patch('cache_manager.services.sweep_keys_by_prefix') as mock_sweep, \
+                patch.dict('cache_manager.services._model_generations'), \
+                patch.object(CacheManagerConfig, 'sweep_old_generations', True), \
+                patch.object(CacheManagerConfig, 'generation_cache_ttl', 5):
+            # another worker bumped the generation meanwhile, this process still has an older one
+            mock_caches['default'].client.get_client.return_value.incr.return_value = 7
+            result = CacheService.bump_model_generation('location')
+        self.assertEqual(result["generation"], 7)
+        mock_sweep.assert_called_once_with(ANY, "oi:1:cs_Location_g6_", delay=10)
+
+    def test_local_cache_drops_values_read_before_an_invalidation(self):
+        local_cache = LocalCache()
+        invalidations = local_cache.invalidations
+        # a writer invalidates the key while the reader is reading Redis
+        local_cache.apply({"keys": ['oi:1:cs_Item_1']})
+        local_cache.set('oi:1:cs_Item_1', 'item', {"id": 1, "code": "old"}, invalidations)
+        self.assertIs(local_cache.get('oi:1:cs_Item_1'), MISSING)
+        local_cache.set('oi:1:cs_Item_1', 'item', {"id": 1, "code": "new"}, local_cache.invalidations)
+        self.assertEqual(local_cache.get('oi:1:cs_Item_1'), {"id": 1, "code": "new"})
+
+    def test_registering_a_model_updates_the_key_models(self):
+        key_prefix = settings.CACHES['default'].get('KEY_PREFIX', '')
+        with patch.dict('cache_manager.registry._cache_models'), patch.dict('cache_manager.registry._model_classes'), \
+                patch('cache_manager.registry._supported_models', None), \
+                patch.dict('cache_manager.services._key_prefix_models'):
+            self.assertNotEqual(get_cache_key_model("cs_Permission_1", key_prefix), "permission")
+            register_cache_model("permission", "auth.Permission")
+            self.assertEqual(get_cache_key_model("cs_Permission_1", key_prefix), "permission")
+
+    def bind_row_sync(self, mode):
+        with patch.object(CacheManagerConfig, 'row_sync_models', {"diagnosis": mode}):
+            bind_cache_signals()
+        self.addCleanup(post_save.disconnect, sender=Diagnosis, dispatch_uid="cache_manager_post_save_diagnosis")
+        self.addCleanup(post_delete.disconnect, sender=Diagnosis, dispatch_uid="cache_manager_post_delete_diagnosis")
+
+    def test_row_sync_refreshes_once_on_commit(self):
+        self.bind_row_sync("refresh")
+        with patch.object(CacheService, 'sync_model_rows') as mock_sync, \
+                self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                first = create_test_diagnosis({"code": "RS1"})
+                second = create_test_diagnosis({"code": "RS2"})
+                first.name = "Changed"
+                first.save()
+        mock_sync.assert_called_once_with("diagnosis", {first.id, second.id}, set())
+
+    def test_row_sync_discards_rolled_back_changes(self):
+        self.bind_row_sync("refresh")
+        with patch.object(CacheService, 'sync_model_rows') as mock_sync, \
+                self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                create_test_diagnosis({"code": "RS3"})
+                raise RuntimeError()
+            with transaction.atomic():
+                kept = create_test_diagnosis({"code": "RS4"})
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    create_test_diagnosis({"code": "RS5"})
+                    raise RuntimeError()
+                last = create_test_diagnosis({"code": "RS6"})
+        mock_sync.assert_called_once_with("diagnosis", {kept.id, last.id}, set())
+
+    def test_row_sync_evicts_invalidated_and_deleted_rows(self):
+        self.bind_row_sync("refresh")
+        diagnosis = create_test_diagnosis({"code": "RS7"})
+        key = get_cache_key(Diagnosis, diagnosis.id)
+        with patch.object(CacheService, 'sync_model_rows') as mock_sync, \
+                self.captureOnCommitCallbacks(execute=True):
+            diagnosis.validity_to = timezone.now()
+            diagnosis.save()
+        mock_sync.assert_called_once_with("diagnosis", set(), {key})
+        self.bind_row_sync("invalidate")
+        other = create_test_diagnosis({"code": "RS8"})
+        with patch.object(CacheService, 'sync_model_rows') as mock_sync, \
+                self.captureOnCommitCallbacks(execute=True):
+            other.name = "Changed"
+            other.save()
+            other.delete()
+        mock_sync.assert_called_once_with("diagnosis", set(), {get_cache_key(Diagnosis, other.id)})
+
+    def test_keys_of_models_with_ttl_are_not_indexed(self):
+        redis_client = MagicMock()
+        pipeline = redis_client.pipeline.return_value
+        with patch.object(CacheManagerConfig, 'preload_ttls', {"diagnosis": 3600}):
+            add_index_members(redis_client, [("cs_Item_1", "item"), ("cs_Diagnosis_1", "diagnosis")])
+            with patch.object(CacheService, 'keyspace_census',
+                              return_value={"diagnosis": {"count": 3, "bytes": 0}}) as mock_census, \
+                    patch.object(CacheService, 'get_model_servers', return_value=[]):
+                census = CacheService.index_census(["item", "diagnosis"])
+        pipeline.sadd.assert_called_once_with(get_index_key("item"), "cs_Item_1")
+        mock_census.assert_called_once_with(["diagnosis"])
+        self.assertEqual(census, {"diagnosis": {"count": 3, "bytes": 0}})
+
+    def test_chunked_queryset_reads_each_row_once(self):
+        expected = [create_test_diagnosis({"code": f"CQ{index}"}).id for index in range(7)]
+        qs = Diagnosis.objects.filter(code__startswith="CQ")
+        for batch_size in (3, 7):
+            for fields, pk_index in (((), None), (("code",), 0), (("pk", "code"), 0), (("code", "id"), 1)):
+                for server_side_cursor in (False, True):
+                    with self.subTest(batch_size=batch_size, fields=fields, server_side_cursor=server_side_cursor):
+                        chunks = list(chunked_queryset(qs, batch_size, *fields,
+                                                       server_side_cursor=server_side_cursor))
+                        self.assertTrue(all(0 < len(chunk) <= batch_size for chunk in chunks))
+                        ids = [row.pk if pk_index is None else row[pk_index] for chunk in chunks for row in chunk]
+                        self.assertEqual(ids, expected)
+
+    def test_incremental_preheat_loads_and_evicts_the_changed_rows(self):
+        store = {}
+        cache = MagicMock()
+        cache.get.side_effect = lambda key, default=None: store.get(key, default)
+        cache.set.side_effect = lambda key, value, timeout=None: store.__setitem__(key, value)
+        cache.delete_many.side_effect = lambda keys: [store.pop(key, None) for key in keys]
+        written, evicted = [], []
+        with patch('cache_manager.services.caches', {"default": cache}), \
+                patch.object(CacheManagerConfig, 'model_cache_versioning', False), \
+                patch('cache_manager.services.get_throttle', return_value=None), \
+                patch('cache_manager.services.use_compact_encoding', return_value=False), \
+                patch('cache_manager.services.set_preloaded_entries',
+                      side_effect=lambda cache, model, cache_data: written.extend(cache_data)), \
+                patch('cache_manager.services.evict_cache_keys',
+                      side_effect=lambda cache, model, keys: evicted.extend(keys)), \
+                patch('cache_manager.services.index_cache_keys'), \
+                patch('cache_manager.services.unlink_keys_by_prefix'), \
+                patch('cache_manager.services.broadcast_invalidation'):
+            changed = create_test_diagnosis({"code": "IP1"})
+            invalidated = create_test_diagnosis({"code": "IP2"})
+            unchanged = create_test_diagnosis({"code": "IP3"})
+            self.assertTrue(CacheService.preload_model_cache("diagnosis", None, incremental=True))
+            self.assertIn(get_cache_key(Diagnosis, unchanged.id), written)
+
+            written.clear()
+            added = create_test_diagnosis({"code": "IP4"})
+            changed.validity_from = timezone.now()
+            changed.save()
+            invalidated.validity_to = timezone.now()
+            invalidated.save()
+            create_test_diagnosis({"code": "IP5", "legacy_id": changed.id, "validity_to": timezone.now()})
+            self.assertTrue(CacheService.preload_model_cache("diagnosis", None, incremental=True))
+            self.assertEqual(set(written), {get_cache_key(Diagnosis, added.id), get_cache_key(Diagnosis, changed.id)})
+            self.assertEqual(evicted, [get_cache_key(Diagnosis, invalidated.id)])
+
+            written.clear()
+            CacheService.clear_all_model_cache("diagnosis")
+            self.assertTrue(CacheService.preload_model_cache("diagnosis", None, incremental=True))
+            valid_ids = Diagnosis.objects.filter(validity_to__isnull=True).values_list("id", flat=True)
+            self.assertEqual(set(written), {get_cache_key(Diagnosis, row_id) for row_id in valid_ids})
+
+    def test_preheat_job_query_resolves_a_created_job(self):
+        store = {}
+        cache = MagicMock()
+        cache.get.side_effect = lambda key, default=None: store.get(key, default)
+        cache.set.side_effect = lambda key, value, timeout=None: store.__setitem__(key, value)
+        with patch('cache_manager.jobs.caches', {"default": cache}):
+            job = PreheatJobService.create(["location", "item"], job_id="job-2", batch_size=500)
+            resolved = Query().resolve_preheat_job(MagicMock(context=MagicMock(user=self.admin_user)), "job-2")
+        self.assertEqual(resolved.job_id, "job-2")
+        self.assertEqual(resolved.status, job["status"])
+        self.assertEqual(resolved.batch_size, 500)
+        self.assertEqual([model.model for model in resolved.models], ["item", "location"])
+
+    def test_location_user_items_count_counts_the_cached_entries(self):
+        users = InteractiveUser.objects.filter(validity_to__isnull=True).count()
+        with patch.object(LocationConfig, 'no_location_check', False):
+            self.assertEqual(CacheService.items_count("location_user"), users + 2)
+        with patch.object(LocationConfig, 'no_location_check', True):
+            self.assertEqual(CacheService.items_count("location_user"), 3)
+        self.assertIsNone(estimate_items_count("location_user"))
+
+    def test_coverage_items_count_counts_the_cached_entries(self):
+        create_test_insuree(with_family=False)
+        keys = {get_coverage_cache_key(family_id, insuree_id)
+                for insurees, _ in iter_coverage_chunks() for insuree_id, family_id in insurees}
+        self.assertEqual(CacheService.items_count("coverage"), len(keys))
+        self.assertIsNone(estimate_items_count("coverage"))
+
+    def test_items_count_estimate_falls_back_to_exact(self):
+        cursor = MagicMock()
+        db_connection = MagicMock(vendor='postgresql')
+        db_connection.cursor.return_value.__enter__.return_value = cursor
+        with patch.object(CacheManagerConfig, 'item_count_strategy', 'estimate'), \
+                patch('cache_manager.services.connection', db_connection), \
+                patch.object(CacheService, 'items_count', return_value=7):
+            cursor.fetchone.return_value = (1234,)
+            self.assertEqual(CacheService.items_count_info("diagnosis"),
+                             {"count": 1234, "strategy": "estimate", "computed_at": ANY})
+            # never analyzed
+            cursor.fetchone.return_value = (-1,)
+            self.assertEqual(CacheService.items_count_info("diagnosis"),
+                             {"count": 7, "strategy": "exact", "computed_at": ANY})
+            db_connection.vendor = 'sqlite'
+            self.assertEqual(CacheService.items_count_info("diagnosis")["strategy"], "exact")
+
+    def test_items_count_cached_is_refreshed_in_background(self):
+        store = {}
+        cache = MagicMock()
+        cache.get.side_effect = lambda key, default=None: store.get(key, default)
+        cache.set.side_effect = lambda key, value, timeout=None: store.__setitem__(key, value)
+        with patch.object(CacheManagerConfig, 'item_count_strategy', 'cached'), \
+                patch('cache_manager.services.caches', {"default": cache}), \
+                patch('cache_manager.services.threading.Thread') as mock_thread, \
+                patch('cache_manager.services.connection'), \
+                patch.object(CacheService, 'items_count', return_value=7):
+            first = CacheService.items_count_info("diagnosis")
+            self.assertEqual((first["count"], first["strategy"]), (7, "cached"))
+            self.assertEqual(CacheService.items_count_info("diagnosis"), first)
+            mock_thread.assert_not_called()
+
+            stale = first["computed_at"] - datetime.timedelta(seconds=CacheManagerConfig.item_count_ttl + 1)
+            store[get_items_count_key("diagnosis")] = {"count": 5, "computed_at": stale}
+            self.assertEqual(CacheService.items_count_info("diagnosis"),
+                             {"count": 5, "computed_at": stale, "strategy": "cached"})
+            self.assertEqual(CacheService.items_count_info("diagnosis")["count"], 5)
+            mock_thread.assert_called_once_with(target=refresh_items_count, args=("diagnosis", True),
+                                                name="cache_manager-count-diagnosis", daemon=True)
+            mock_thread.call_args.kwargs["target"](*mock_thread.call_args.kwargs["args"])
+        self.assertEqual(store[get_items_count_key("diagnosis")]["count"], 7)
+
+    def test_cache_info_exposes_the_count_strategy(self):
+        computed_at = datetime.datetime(2024, 1, 2, 3, 4, 5)
+        query = """
+        query {
+            cacheInfo(first: 100) {
+                edges {
+                    node {
+                        model
+                        maxItemCount
+                        countStrategy
+                        countComputedAt
+                    }
+                }
+            }
+        }
+        """
+        census = {model: {"count": 0, "bytes": 0} for model in CacheService.openimis_models}
+        with patch.object(CacheManagerConfig, 'stats_enabled', False), \
+                patch.object(CacheManagerConfig, 'key_index_enabled', False), \
+                patch.object(CacheService, 'keyspace_census', return_value=census), \
+                patch.object(CacheService, 'items_count_info',
+                             return_value={"count": 42, "strategy": "cached", "computed_at": computed_at}):
+            response = self.query(query, headers={"HTTP_AUTHORIZATION": f"Bearer {self.admin_token}"})
+        self.assertResponseNoErrors(response)
+        edges = json.loads(response.content)["data"]["cacheInfo"]["edges"]
+        nodes = {edge["node"]["model"]: edge["node"] for edge in edges}
+        self.assertEqual(nodes["diagnosis"]["maxItemCount"], 42)
+        self.assertEqual(nodes["diagnosis"]["countStrategy"], "cached")
+        self.assertEqual(nodes["diagnosis"]["countComputedAt"], computed_at.isoformat())
+
+    def get_backend(self):
+        backend = CacheManagerRedisCache("redis://127.0.0.1:6379/1", {"KEY_PREFIX": "cm-test"})
+        backend._client = MagicMock()
+        store = {"cs_Diagnosis_1": "first"}
+        backend.client.get.side_effect = lambda key, default=None, **kwargs: store.get(key, default)
+        backend.client.get_many.side_effect = lambda keys, **kwargs: {key: store[key] for key in keys if key in store}
+        backend.client.set.return_value = True
+        return backend
+
+    def test_backend_records_hits_and_misses(self):
+        backend = self.get_backend()
+        with patch.object(CacheManagerConfig, 'stats_enabled', True), \
+                patch('cache_manager.backends.caches'), \
+                patch('cache_manager.backends._stats_collector') as mock_collector:
+            self.assertEqual(backend.get("cs_Diagnosis_1"), "first")
+            self.assertIsNone(backend.get("cs_Diagnosis_2"))
+            self.assertEqual(backend.get_many(["cs_Diagnosis_1", "cs_Diagnosis_2", "cs_Diagnosis_3"]),
+                             {"cs_Diagnosis_1": "first"})
+            backend.get("other_key")
+        self.assertEqual([call.args[:3] for call in mock_collector.record.call_args_list], [
+            ("diagnosis", HITS, 1),
+            ("diagnosis", MISSES, 1),
+            ("diagnosis", HITS, 1),
+            ("diagnosis", MISSES, 2),
+        ])
+        # the latency of a get_many is recorded once
+        self.assertIsNone(mock_collector.record.call_args_list[3].args[3])
+
+    def test_backend_maintains_the_key_index(self):
+        backend = self.get_backend()
+        with patch.object(CacheManagerConfig, 'key_index_enabled', True), \
+                patch('cache_manager.services.add_index_members') as mock_add, \
+                patch('cache_manager.services.remove_index_members') as mock_remove:
+            backend.set("cs_Diagnosis_1", "first")
+            backend.set_many({"cs_Diagnosis_2": "second", "other_key": "other"})
+            backend.delete("cs_Diagnosis_1")
+            backend.delete_many(["cs_Diagnosis_2"])
+        client = backend.client.get_client()
+        self.assertEqual(mock_add.call_args_list, [
+            call(client, [("cm-test:1:cs_Diagnosis_1", "diagnosis")]),
+            call(client, [("cm-test:1:cs_Diagnosis_2", "diagnosis")]),
+        ])
+        self.assertEqual(mock_remove.call_args_list, [
+            call(client, [("cm-test:1:cs_Diagnosis_1", "diagnosis")]),
+            call(client, [("cm-test:1:cs_Diagnosis_2", "diagnosis")]),
+        ])
+
+    def test_row_sync_skips_unknown_models(self):
+        with self.assertLogs("cache_manager.signals", level="WARNING") as logs:
+            with patch.object(CacheManagerConfig, 'row_sync_models', {"unknown": "refresh", "diagnosis": "refresh"}):
+                bind_cache_signals()
+        self.addCleanup(post_save.disconnect, sender=Diagnosis, dispatch_uid="cache_manager_post_save_diagnosis")
+        self.addCleanup(post_delete.disconnect, sender=Diagnosis, dispatch_uid="cache_manager_post_delete_diagnosis")
+        self.assertIn("unknown", logs.output[0])
+        self.assertTrue(post_save.has_listeners(Diagnosis))
@@ -0,0 +1,110 @@
+"""
+Adaptive throttle of the bulk operations (clears, sweeps, preheating) running against the Redis serving the live
+traffic. Each batch waits for its share of the throttle_ops_per_sec and throttle_bytes_per_sec budgets, and every
+throttle_check_interval seconds the latency of a PING and the instantaneous_ops_per_sec of the server are measured:
+when one of them is above its threshold, the throttle backs off (the waits are doubled, up to MAX_BACKOFF times),
+and it recovers progressively once the server is healthy again.
+"""
+import logging
+import pickle
+import threading
+import time
+
+from cache_manager.apps import CacheManagerConfig
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF = 32
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+class Throttle:
+    """
+    Throttle shared by the bulk operations of a process on one Redis server.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+        self.backoff = 1
+        self.checked_at = 0
+
+    def wait(self, ops, entries=None):
+        """
+        Waits after a batch of ops commands, writing the given {key: value} entries if any.
+        """
+        self.check_server()
+        delay = 0
+        if CacheManagerConfig.throttle_ops_per_sec:
+            delay = ops / CacheManagerConfig.throttle_ops_per_sec
+        if CacheManagerConfig.throttle_bytes_per_sec and entries:
+            delay = max(delay, estimate_entries_bytes(entries) / CacheManagerConfig.throttle_bytes_per_sec)
+        with self.lock:
+            delay *= self.backoff
+            if self.backoff > 1:
+                delay += CacheManagerConfig.throttle_backoff_pause * self.backoff
+            now = time.monotonic()
+            self.next_slot = max(self.next_slot, now) + delay
+            pause = self.next_slot - now
+        if pause > 0:
+            time.sleep(pause)
+
+    def check_server(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked_at < CacheManagerConfig.throttle_check_interval:
+                return
+            self.checked_at = now
+        try:
+            started = time.perf_counter()
+            self.redis_client.ping()
+            latency_ms = (time.perf_counter() - started) * 1000
+        except Exception as exc:
+            logger.warning("Failed to measure the latency of Redis: %s", exc)
+            return
+        server_ops = 0
+        if CacheManagerConfig.throttle_max_server_ops:
+            try:
+                server_ops = get_instantaneous_ops(self.redis_client.info("stats"))
+            except Exception as exc:
+                logger.warning("Failed to read the load of Redis: %s", exc)
+        overloaded = latency_ms > CacheManagerConfig.throttle_max_latency_ms or bool(
+            CacheManagerConfig.throttle_max_server_ops and server_ops > CacheManagerConfig.throttle_max_server_ops)
+        with self.lock:
+            backoff = min(self.backoff * 2, MAX_BACKOFF) if overloaded else max(self.backoff // 2, 1)
+            if backoff != self.backoff:
+                logger.info("Redis %s (latency %.1fms, %s ops/s), bulk operations backoff x%s",
+                            "overloaded" if overloaded else "recovering", latency_ms, server_ops, backoff)
+            self.backoff = backoff
+
+
+def get_instantaneous_ops(info):
+    # a cluster client returns the info of each node
+    if info and all(isinstance(value, dict) for value in info.values()):
+        return max(get_instantaneous_ops(node_info) for node_info in info.values())
+    return int(info.get("instantaneous_ops_per_sec", 0))
+
+
+def estimate_entries_bytes(entries):
+    """
+    Estimates the bytes written for the entries from the serialized size of one of them.
+    """
+    key, value = next(iter(entries.items()))
+    size = len(value) if isinstance(value, (bytes, bytearray)) else len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    return (size + len(str(key))) * len(entries)
+
+
+def get_throttle(redis_client):
+    """
+    Returns the throttle of the Redis server of the client, or None when throttle_enabled is not set.
+    """
+    if not CacheManagerConfig.throttle_enabled:
+        return None
+    server = id(getattr(redis_client, "connection_pool", redis_client))
+    with _throttles_lock:
+        if server not in _throttles:
+            _throttles[server] = Throttle(redis_client)
+        return _throttles[server]
@@ -22,6 +22,7 @@ setup(
     install_requires=[
         'django',
         'django-db-signals',
+        'django-redis',
         'djangorestframework',
         'openimis-be-core'
     ],